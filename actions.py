@@ -0,0 +1,76 @@
+import threading
+from collections import deque
+from typing import Deque, Dict, List, Set
+
+DEFAULT_MAX_PENDING = 16
+DEFAULT_ACTIONS_PER_TICK = 1
+
+ACCEPTED = 'accepted'
+QUEUE_FULL = 'queue full'
+UNKNOWN_ACTOR = 'unknown actor'
+
+
+class ActionQueues:
+    """Bounded FIFO of submitted actions per actor, drained by the step thread.
+
+    HTTP threads only append to a deque and the step thread only pops from it, both atomic
+    under the GIL, so the queues take no lock. The bound is best effort: racing submitters
+    may overshoot it by a few entries. Submitters mark their actor ready after appending and
+    drain_all swaps the ready set out first, both under ready_lock, so an action is either in
+    this drain or marked in the set the next one takes.
+    """
+
+    def __init__(self, max_pending=DEFAULT_MAX_PENDING, actions_per_tick=DEFAULT_ACTIONS_PER_TICK):
+        self.max_pending = max_pending
+        self.actions_per_tick = actions_per_tick
+        self.queues: Dict[int, Deque] = {}
+        self.ready: Set[int] = set()
+        self.ready_lock = threading.Lock()
+        self.rejected = 0
+
+    def open(self, actor_id):
+        self.queues[actor_id] = deque()
+
+    def close(self, actor_id):
+        self.queues.pop(actor_id, None)
+        with self.ready_lock:
+            self.ready.discard(actor_id)
+
+    def submit(self, actor_id, action):
+        queue = self.queues.get(actor_id)
+        if queue is None:
+            return UNKNOWN_ACTOR
+        if len(queue) >= self.max_pending:
+            self.rejected += 1
+            return QUEUE_FULL
+        queue.append(action)
+        with self.ready_lock:
+            self.ready.add(actor_id)
+        return ACCEPTED
+
+    def drain(self, actor_id) -> List:
+        queue = self.queues.get(actor_id)
+        actions = []
+        while queue and len(actions) < self.actions_per_tick:
+            actions.append(queue.popleft())
+        return actions
+
+    def drain_all(self) -> Dict[int, List]:
+        """Takes this tick's actions of every actor at once, so all actors see the same cut-off."""
+        with self.ready_lock:
+            ready, self.ready = self.ready, set()
+        drained = {}
+        again = []
+        for actor_id in ready:
+            actions = self.drain(actor_id)
+            if actions:
+                drained[actor_id] = actions
+            if self.queues.get(actor_id):
+                again.append(actor_id)
+        with self.ready_lock:
+            self.ready.update(again)
+        return drained
+
+    def pending(self, actor_id):
+        queue = self.queues.get(actor_id)
+        return len(queue) if queue is not None else 0
@@ -0,0 +1,232 @@
+from collections import deque
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from messages import MessageLog
+from spatial_index import SpatialHash
+
+INITIAL_CAPACITY = 64
+ACTOR_ATTRIBUTES = ('position', 'enabled', 'creation_time', 'name', 'messages')
+STATE_ATTRIBUTES = ('position', 'enabled', 'creation_time', 'name')
+REMOVAL_HISTORY = 4 * 60
+
+
+class ActorView:
+    """Dict-like handle on one actor row, so scripts keep using actors[actor_id]['position'] and friends."""
+
+    __slots__ = ('table', 'actor_id')
+
+    def __init__(self, table: 'ActorTable', actor_id):
+        self.table = table
+        self.actor_id = actor_id
+
+    def __contains__(self, attribute):
+        return attribute in ACTOR_ATTRIBUTES
+
+    def __getitem__(self, attribute):
+        table = self.table
+        slot = table.slot_of[self.actor_id]
+        if attribute == 'position':
+            return table.positions[slot].tolist()
+        elif attribute == 'enabled':
+            return bool(table.enabled[slot])
+        elif attribute == 'creation_time':
+            return int(table.creation_frame[slot])
+        elif attribute == 'name':
+            return table.names[slot]
+        elif attribute == 'messages':
+            return table.message_log.of(self.actor_id) if table.message_log is not None else []
+        raise KeyError(attribute)
+
+    def __setitem__(self, attribute, value):
+        table = self.table
+        slot = table.slot_of[self.actor_id]
+        if attribute == 'position':
+            table.place(self.actor_id, *value)
+        elif attribute == 'enabled':
+            table.enabled[slot] = value
+            table.changed_frame[slot] = table.frame
+        elif attribute == 'creation_time':
+            table.creation_frame[slot] = value
+        elif attribute == 'name':
+            table.names[slot] = value
+        else:
+            raise KeyError(attribute)
+
+    def keys(self):
+        return ACTOR_ATTRIBUTES
+
+    def to_dict(self, attributes=ACTOR_ATTRIBUTES):
+        return {attribute: self[attribute] for attribute in attributes}
+
+
+class ActorTable:
+    """Actors stored column-wise in NumPy arrays, rows of removed actors are reused.
+
+    Position changes are mirrored into spatial_index when one is given, messages are read from message_log.
+    Every spawn, move and enable/disable stamps changed_frame with the current frame, and removals and
+    cell crossings are remembered for REMOVAL_HISTORY frames, so "what changed since frame F" needs no
+    extra bookkeeping.
+    """
+
+    def __init__(self, capacity=INITIAL_CAPACITY, spatial_index: Optional[SpatialHash] = None,
+                 message_log: Optional[MessageLog] = None):
+        self.spatial_index = spatial_index
+        self.message_log = message_log
+        self.positions = np.zeros((capacity, 2), dtype=np.int64)
+        self.enabled = np.zeros(capacity, dtype=bool)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.creation_frame = np.zeros(capacity, dtype=np.int64)
+        self.changed_frame = np.zeros(capacity, dtype=np.int64)
+        self.ids = np.full(capacity, -1, dtype=np.int64)
+        self.names: List[str] = [''] * capacity
+        self.slot_of: Dict[int, int] = {}
+        self.free_slots: List[int] = list(range(capacity - 1, -1, -1))
+        self.frame = 0
+        self.removed: Deque[Tuple[int, int]] = deque()
+        # (frame, actor_id, cell) whenever an actor crosses into another spatial index cell.
+        self.departures: Deque[Tuple[int, int, Tuple[int, int]]] = deque()
+
+    @property
+    def capacity(self):
+        return len(self.ids)
+
+    def __len__(self):
+        return len(self.slot_of)
+
+    def __contains__(self, actor_id):
+        return actor_id in self.slot_of
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.slot_of)
+
+    def __getitem__(self, actor_id) -> ActorView:
+        if actor_id not in self.slot_of:
+            raise KeyError(actor_id)
+        return ActorView(self, actor_id)
+
+    def keys(self):
+        return self.slot_of.keys()
+
+    def items(self):
+        return ((actor_id, ActorView(self, actor_id)) for actor_id in self.slot_of)
+
+    def grow(self):
+        old = self.capacity
+        new = old * 2
+        self.positions = np.resize(self.positions, (new, 2))
+        for name in ('enabled', 'alive', 'creation_frame', 'changed_frame', 'ids'):
+            column = getattr(self, name)
+            grown = np.zeros(new, dtype=column.dtype) if name != 'ids' else np.full(new, -1, dtype=column.dtype)
+            grown[:old] = column
+            setattr(self, name, grown)
+        self.names.extend([''] * old)
+        self.free_slots.extend(range(new - 1, old - 1, -1))
+
+    def add(self, actor_id, position, creation_frame, name, enabled=True):
+        if actor_id in self.slot_of:
+            raise ValueError('actor {} already exists'.format(actor_id))
+        if not self.free_slots:
+            self.grow()
+        slot = self.free_slots.pop()
+        self.positions[slot] = position
+        self.enabled[slot] = enabled
+        self.alive[slot] = True
+        self.creation_frame[slot] = creation_frame
+        self.changed_frame[slot] = self.frame
+        self.ids[slot] = actor_id
+        self.names[slot] = name
+        self.slot_of[actor_id] = slot
+        if self.spatial_index is not None:
+            self.spatial_index.insert(actor_id, *position)
+        return slot
+
+    def remove(self, actor_id):
+        slot = self.slot_of.pop(actor_id)
+        self.alive[slot] = False
+        self.enabled[slot] = False
+        self.ids[slot] = -1
+        self.names[slot] = ''
+        self.free_slots.append(slot)
+        self.removed.append((self.frame, actor_id))
+        if self.spatial_index is not None:
+            self.spatial_index.remove(actor_id)
+        if self.message_log is not None:
+            self.message_log.drop_actor(actor_id)
+
+    def position(self, actor_id) -> Tuple[int, int]:
+        x, y = self.positions[self.slot_of[actor_id]].tolist()
+        return x, y
+
+    def place(self, actor_id, x, y):
+        slot = self.slot_of[actor_id]
+        if self.spatial_index is not None:
+            left = self.spatial_index.cell_of(*self.positions[slot].tolist())
+            if left != self.spatial_index.cell_of(x, y):
+                self.departures.append((self.frame, actor_id, left))
+        self.positions[slot] = (x, y)
+        self.changed_frame[slot] = self.frame
+        if self.spatial_index is not None:
+            self.spatial_index.move(actor_id, x, y)
+
+    def move(self, actor_id, dx, dy) -> Tuple[int, int]:
+        x, y = self.position(actor_id)
+        self.place(actor_id, x + dx, y + dy)
+        return x + dx, y + dy
+
+    def is_enabled(self, actor_id):
+        slot = self.slot_of.get(actor_id)
+        return slot is not None and bool(self.enabled[slot])
+
+    def advance(self, frame):
+        self.frame = frame
+        while self.removed and frame - self.removed[0][0] > REMOVAL_HISTORY:
+            self.removed.popleft()
+        while self.departures and frame - self.departures[0][0] > REMOVAL_HISTORY:
+            self.departures.popleft()
+
+    def changed_since(self, actor_ids, frame) -> List[int]:
+        if not actor_ids:
+            return []
+        actor_ids = np.asarray(actor_ids, dtype=np.int64)
+        slots = np.fromiter((self.slot_of[k] for k in actor_ids.tolist()), dtype=np.intp, count=len(actor_ids))
+        return actor_ids[self.changed_frame[slots] >= frame].tolist()
+
+    def removed_since(self, frame) -> List[int]:
+        removed = []
+        for removal_frame, actor_id in reversed(self.removed):
+            if removal_frame < frame:
+                break
+            removed.append(actor_id)
+        removed.reverse()
+        return removed
+
+    def departed_since(self, frame, cells) -> List[int]:
+        """Actors that left any of cells since frame, found without knowing how far they went."""
+        cells = set(cells)
+        departed = set()
+        for departure_frame, actor_id, cell in reversed(self.departures):
+            if departure_frame < frame:
+                break
+            if cell in cells and actor_id in self.slot_of:
+                departed.add(actor_id)
+        return sorted(departed)
+
+    def enabled_slots(self):
+        return np.flatnonzero(self.enabled & self.alive)
+
+    def enabled_ids(self) -> List[int]:
+        return self.ids[self.enabled_slots()].tolist()
+
+    def enabled_positions(self):
+        slots = self.enabled_slots()
+        return self.ids[slots], self.positions[slots]
+
+    def chunk_buckets(self, chunk_shape) -> Dict[Tuple[int, int], np.ndarray]:
+        ids, positions = self.enabled_positions()
+        chunks = np.floor_divide(positions, np.asarray(chunk_shape))
+        keys, inverse = np.unique(chunks, axis=0, return_inverse=True)
+        order = np.argsort(inverse.ravel(), kind='stable')
+        splits = np.split(ids[order], np.cumsum(np.bincount(inverse.ravel(), minlength=len(keys)))[:-1])
+        return {tuple(k): v for k, v in zip(keys.tolist(), splits)}
@@ -1,35 +1,184 @@
-from typing import Dict, Tuple
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Set, Tuple
 
+import cv2
 import numpy as np
 
 import visualization
+from chunk_cache import ChunkCache
+from chunk_store import RegionChunkStore
 from map import SimulationMap
+from metrics import CHUNK_ENCODE_SECONDS, CHUNK_GENERATE_SECONDS, CHUNK_RENDER_SECONDS, IMAGE_CACHE_LOOKUPS
+from tile_pyramid import TilePyramid
+from visualization import EncodedImage
+
+DEFAULT_MAX_CHUNKS = 4096
+DEFAULT_MAX_IMAGES = 1024
+IMAGE_FORMATS = ('.jpg', '.png')
 
 
 class AutoExpandingMap:
     def render_chunk(self, chunk_x, chunk_y):
-        self.assert_exist_chunk((chunk_x, chunk_y))
-        img = np.zeros((self.chunk_y * 16, self.chunk_x * 16, 3), dtype=np.uint8)
-        for x in range(self.chunk_x):
-            for y in range(self.chunk_y):
-                img[y * 16:(y + 1) * 16, x * 16:(x + 1) * 16, :] = self.tilemap[
-                    self.chunks[(chunk_x, chunk_y)].type_map[x, y]]
+        chunk = self.get_chunk((chunk_x, chunk_y))
+        start = time.perf_counter()
+        size = self.tilemap.size
+        # type_map is indexed [x, y], the image is laid out rows (y) first.
+        tiles = self.tilemap.atlas[chunk.type_map.T]
+        img = tiles.transpose(0, 2, 1, 3, 4).reshape(self.chunk_y * size, self.chunk_x * size, tiles.shape[-1])
+        CHUNK_RENDER_SECONDS.observe(time.perf_counter() - start)
         return img
 
-    def __init__(self, chunk_shape):
-        self.chunks: Dict[Tuple[int, int], SimulationMap] = {}
+    def cached_image(self, chunk_x, chunk_y, ext=".jpg", count=True) -> Optional[EncodedImage]:
+        key = (chunk_x, chunk_y, ext)
+        with self.lock:
+            image = self.images.get(key)
+            if image is not None:
+                self.images.move_to_end(key)
+        if count:
+            IMAGE_CACHE_LOOKUPS.inc(result='hit' if image is not None else 'miss')
+        return image
+
+    def encoded_chunk(self, chunk_x, chunk_y, ext=".jpg") -> Optional[EncodedImage]:
+        # Callers looked the image up already, this re-check is for requests that raced on the same chunk.
+        image = self.cached_image(chunk_x, chunk_y, ext, count=False)
+        if image is not None:
+            return image
+        img = self.render_chunk(chunk_x, chunk_y)
+        start = time.perf_counter()
+        succ, enc = cv2.imencode(ext, img)
+        CHUNK_ENCODE_SECONDS.observe(time.perf_counter() - start, format=ext)
+        if not succ:
+            return None
+        image = EncodedImage.of(enc.tobytes())
+        with self.lock:
+            self.images[(chunk_x, chunk_y, ext)] = image
+            while len(self.images) > self.max_images:
+                self.images.popitem(last=False)
+        return image
+
+    def cached_tile(self, z, tile_x, tile_y, ext=".jpg") -> Optional[EncodedImage]:
+        return self.pyramid.cached_tile(z, tile_x, tile_y, ext)
+
+    def encoded_tile(self, z, tile_x, tile_y, ext=".jpg") -> Optional[EncodedImage]:
+        return self.pyramid.encoded_tile(z, tile_x, tile_y, ext)
+
+    def __init__(self, chunk_shape, seed=None, max_chunks: Optional[int] = DEFAULT_MAX_CHUNKS,
+                 max_bytes: Optional[int] = None, pin_radius=1, store_directory: Optional[str] = None,
+                 max_images=DEFAULT_MAX_IMAGES):
+        self.chunks = ChunkCache(max_chunks, max_bytes)
+        self.images: 'OrderedDict[Tuple[int, int, str], EncodedImage]' = OrderedDict()
+        self.max_images = max_images
         self.chunk_x, self.chunk_y = chunk_shape
+        self.store: Optional[RegionChunkStore] = None
+        if store_directory is not None:
+            # An existing store dictates the seed, new ones record it.
+            self.store = RegionChunkStore(store_directory, chunk_shape, seed)
+            seed = self.store.seed
+        # Without an explicit seed a fresh one is drawn, so chunks stay reproducible for this world's lifetime.
+        self.seed = seed if seed is not None else np.random.SeedSequence().entropy
+        self.pin_radius = pin_radius
+        self.bounds: Optional[Tuple[int, int, int, int]] = None
         self.tilemap = visualization.TileSet(16)
+        self.pyramid = TilePyramid(self, self.tilemap)
+        self.max_tile_level = self.pyramid.max_level
+        # Guards the caches and the store. Chunks are generated and encoded outside of it,
+        # concurrent requests for the same missing chunk wait on a single generation.
+        self.lock = threading.RLock()
+        self.pending: Dict[Tuple[int, int], threading.Event] = {}
+        # Every chunk generated or loaded so far, evicting a chunk from the cache does not forget it.
+        self.generated: Set[Tuple[int, int]] = set()
 
     def __getitem__(self, args):
         x, y = args
         chunk_x, inchunk_x = divmod(x, self.chunk_x)
         chunk_y, inchunk_y = divmod(y, self.chunk_y)
-        chunk_index = (chunk_x, chunk_y)
-        self.assert_exist_chunk(chunk_index)
-        return self.chunks[chunk_index].height_map[inchunk_x, inchunk_y], \
-               self.chunks[chunk_index].type_map[inchunk_x, inchunk_y]
+        chunk = self.get_chunk((chunk_x, chunk_y))
+        return chunk.height_map[inchunk_x, inchunk_y], chunk.type_map[inchunk_x, inchunk_y]
+
+    def get_chunk(self, chunk_index) -> SimulationMap:
+        while True:
+            with self.lock:
+                chunk = self.chunks.get(chunk_index)
+                if chunk is not None:
+                    return chunk
+                chunk = self.store.load(chunk_index) if self.store is not None else None
+                if chunk is not None:
+                    self.chunks.put(chunk_index, chunk)
+                    self.generated.add(chunk_index)
+                    self.extend_bounds(chunk_index)
+                    return chunk
+                pending = self.pending.get(chunk_index)
+                if pending is None:
+                    pending = self.pending[chunk_index] = threading.Event()
+                    break
+            pending.wait()
+
+        try:
+            start = time.perf_counter()
+            chunk = SimulationMap((self.chunk_x, self.chunk_y), *chunk_index, seed=self.seed)
+            CHUNK_GENERATE_SECONDS.observe(time.perf_counter() - start, source='request')
+            return self.insert_chunk(chunk_index, chunk)
+        finally:
+            with self.lock:
+                del self.pending[chunk_index]
+            pending.set()
+
+    def has_chunk(self, chunk_index):
+        with self.lock:
+            return chunk_index in self.chunks or (self.store is not None and chunk_index in self.store)
+
+    def was_generated(self, chunk_index):
+        """Whether the chunk exists, even if it was evicted since and has to be generated again."""
+        with self.lock:
+            return chunk_index in self.generated or self.has_chunk(chunk_index)
+
+    def insert_chunk(self, chunk_index, chunk: SimulationMap) -> SimulationMap:
+        """Adds a freshly generated chunk, unless another generator got there first."""
+        with self.lock:
+            resident = self.chunks.peek(chunk_index)
+            if resident is not None:
+                return resident
+            if self.store is not None:
+                self.store.save(chunk_index, chunk)
+            self.chunks.put(chunk_index, chunk)
+            # A chunk generated again after eviction is identical to the old one, its images are still valid.
+            if chunk_index in self.generated:
+                return chunk
+            self.generated.add(chunk_index)
+            for ext in IMAGE_FORMATS:
+                self.images.pop((*chunk_index, ext), None)
+            self.extend_bounds(chunk_index)
+        self.pyramid.invalidate(chunk_index, IMAGE_FORMATS)
+        return chunk
+
+    def flush(self):
+        """Writes the store's dirty pages to disk, chunks are otherwise only written back when the OS decides."""
+        if self.store is not None:
+            self.store.flush()
 
     def assert_exist_chunk(self, chunk_index):
-        if chunk_index not in self.chunks:
-            self.chunks[chunk_index] = SimulationMap((self.chunk_x, self.chunk_y), *chunk_index)
+        self.get_chunk(chunk_index)
+
+    def extend_bounds(self, chunk_index):
+        cx, cy = chunk_index
+        if self.bounds is None:
+            self.bounds = (cx, cx, cy, cy)
+        else:
+            x1, x2, y1, y2 = self.bounds
+            self.bounds = (min(x1, cx), max(x2, cx), min(y1, cy), max(y2, cy))
+
+    def chunk_of(self, x, y):
+        return x // self.chunk_x, y // self.chunk_y
+
+    def pin_around(self, positions: Iterable[Tuple[int, int]]):
+        r = self.pin_radius
+        positions = np.asarray(list(positions) if not isinstance(positions, np.ndarray) else positions,
+                               dtype=np.int64).reshape(-1, 2)
+        centres = np.unique(np.floor_divide(positions, (self.chunk_x, self.chunk_y)), axis=0)
+        offsets = np.arange(-r, r + 1)
+        ring = np.stack(np.meshgrid(offsets, offsets, indexing='ij'), axis=-1).reshape(-1, 2)
+        pinned = set(map(tuple, (centres[:, None, :] + ring[None, :, :]).reshape(-1, 2).tolist()))
+        with self.lock:
+            self.chunks.pin(pinned)
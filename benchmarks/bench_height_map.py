@@ -0,0 +1,46 @@
+import argparse
+import time
+
+import numpy as np
+
+from map import HEIGHT_MAP_SAMPLES, Perlin, make_height_map
+
+
+def make_height_map_scalar(shape, xM, yM):
+    map_array = np.zeros(shape, dtype=np.float32)
+
+    perlin = Perlin()
+
+    for x in range(shape[0]):
+        for y in range(shape[1]):
+            map_array[x, y] = sum(perlin.noise3d((x / 4) + (xM * (shape[0] / 4)),
+                                                 (y / 4) + (yM * (shape[1] / 4)),
+                                                 np.random.random_sample()) for i in range(HEIGHT_MAP_SAMPLES)) / HEIGHT_MAP_SAMPLES
+    return (map_array * 240).astype(np.uint8)
+
+
+def chunks_per_second(generator, shape, chunks):
+    start = time.perf_counter()
+    maps = [generator(shape, i, -i) for i in range(chunks)]
+    elapsed = time.perf_counter() - start
+    return chunks / elapsed, np.stack(maps)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare scalar and vectorized height map generation.')
+    parser.add_argument('--chunks', type=int, default=20)
+    parser.add_argument('--size', type=int, default=32)
+    args = parser.parse_args()
+    shape = (args.size, args.size)
+
+    before, scalar_maps = chunks_per_second(make_height_map_scalar, shape, args.chunks)
+    after, vector_maps = chunks_per_second(make_height_map, shape, args.chunks)
+
+    print(f'scalar:     {before:10.1f} chunks/s')
+    print(f'vectorized: {after:10.1f} chunks/s ({after / before:.1f}x)')
+    print(f'mean height scalar={scalar_maps.mean():.2f} vectorized={vector_maps.mean():.2f}')
+    print(f'std height  scalar={scalar_maps.std():.2f} vectorized={vector_maps.std():.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import argparse
+import random
+import time
+
+from rvm import rvm
+
+IDLE_SCRIPT = 'def step(ctx):\n    pass\n'
+
+
+def linear_look_direction(vm, direction, viewing_actor):
+    viewer_position = list(vm.actors[viewing_actor]['position'])
+    if direction == rvm.Direction.N:
+        viewer_position[1] -= 1
+    elif direction == rvm.Direction.S:
+        viewer_position[1] += 1
+    elif direction == rvm.Direction.W:
+        viewer_position[0] -= 1
+    elif direction == rvm.Direction.E:
+        viewer_position[0] += 1
+    positioned_actor = list(filter(lambda k: vm.actors[k]['position'] == viewer_position, vm.actors.keys()))
+    return viewer_position, positioned_actor[0] if len(positioned_actor) > 0 else None
+
+
+def linear_actors_near(vm, viewing_actor, radius):
+    vx, vy = vm.actors[viewing_actor]['position']
+    return sorted(k for k, a in vm.actors.items() if k != viewing_actor and
+                  (a['position'][0] - vx) ** 2 + (a['position'][1] - vy) ** 2 <= radius * radius)
+
+
+def queries_per_second(query, vm, queries):
+    ids = list(vm.actors)
+    start = time.perf_counter()
+    for i in range(queries):
+        query(ids[i % len(ids)])
+    return queries / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare linear scans with the actor spatial index.')
+    parser.add_argument('--actors', type=int, nargs='+', default=[1000, 5000, 20000])
+    parser.add_argument('--extent', type=int, default=2000, help='actors are spread over an extent x extent area')
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--radius', type=int, default=10)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    for count in args.actors:
+        vm = rvm.RVMPersistentContext(seed=0)
+        for _ in range(count):
+            vm.add_actor(rvm.RVMScript(IDLE_SCRIPT, 'bench'),
+                         (rng.randrange(args.extent), rng.randrange(args.extent)))
+        results = {
+            'look_direction linear': queries_per_second(
+                lambda a: linear_look_direction(vm, rvm.Direction.N, a), vm, args.queries),
+            'look_direction index': queries_per_second(
+                lambda a: vm.look_direction(rvm.Direction.N, a), vm, args.queries),
+            'actors_near linear': queries_per_second(
+                lambda a: linear_actors_near(vm, a, args.radius), vm, args.queries),
+            'actors_near index': queries_per_second(
+                lambda a: vm.actors_near(a, args.radius), vm, args.queries),
+        }
+        for label, qps in results.items():
+            print('{:7d} actors {:24} {:12.0f} queries/s'.format(count, label, qps))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+import argparse
+import http.client
+import json
+import random
+import threading
+import time
+import urllib.parse
+from collections import defaultdict
+
+MOVES = ['UP', 'DOWN', 'LEFT', 'RIGHT']
+
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class SimulatedClient:
+    def __init__(self, host, port, name, results, lock, rng):
+        self.connection = http.client.HTTPConnection(host, port, timeout=30)
+        self.name = name
+        self.results = results
+        self.lock = lock
+        self.rng = rng
+        self.actor_id = None
+        self.position = (0, 0)
+
+    def request(self, label, method, path, body=None):
+        start = time.perf_counter()
+        try:
+            self.connection.request(method, path, body=body)
+            response = self.connection.getresponse()
+            data = response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            data, status = b'', None
+        elapsed = time.perf_counter() - start
+        ok = status is not None and status < 400
+        with self.lock:
+            self.results[label].append(elapsed)
+            # 429 is the server pushing back on a full action queue, not a failure.
+            if status == 429:
+                self.results[label + ' rejected'].append(elapsed)
+            elif not ok:
+                self.results[label + ' errors'].append(elapsed)
+        return data if ok else None
+
+    def run(self, deadline):
+        data = self.request('POST /start/', 'POST', '/start/' + self.name)
+        if data is None:
+            return
+        self.actor_id = json.loads(data)['actor_id']
+        while time.monotonic() < deadline:
+            roll = self.rng.random()
+            if roll < 0.4:
+                data = self.request('GET /self_status/', 'GET', '/self_status/{}'.format(self.actor_id))
+                if data is not None and 'pos' in json.loads(data):
+                    self.position = tuple(json.loads(data)['pos'])
+            elif roll < 0.8:
+                action = {'act': 'MOVE', 'args': self.rng.choice(MOVES)}
+                self.request('POST /action/', 'POST', '/action/{}'.format(self.actor_id), json.dumps(action))
+            elif roll < 0.95:
+                cx = self.position[0] // 32 + self.rng.randint(-2, 2)
+                cy = self.position[1] // 32 + self.rng.randint(-2, 2)
+                self.request('GET /chunk/', 'GET', '/chunk/{}/{}'.format(cx, cy))
+            else:
+                self.request('GET /status/', 'GET', '/status/')
+        self.connection.close()
+
+
+def start_local_server(seed):
+    import main
+    from rvm import rvm
+    from scheduler import TickScheduler
+
+    vm = rvm.RVMPersistentContext(seed=seed)
+    server = main.make_server(vm, ('127.0.0.1', 0))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    threading.Thread(target=TickScheduler(vm.step).run, daemon=True).start()
+    return server.server_address
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Drive simulated clients against a Vitanet server.')
+    parser.add_argument('--url', default=None, help='server to test, a local one is started if omitted')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', default=None, help='write the report to this file')
+    args = parser.parse_args()
+
+    if args.url is None:
+        host, port = start_local_server(args.seed)
+    else:
+        url = urllib.parse.urlsplit(args.url)
+        host, port = url.hostname, url.port or 80
+
+    results = defaultdict(list)
+    lock = threading.Lock()
+    deadline = time.monotonic() + args.duration
+    clients = [SimulatedClient(host, port, 'load{}'.format(i), results, lock, random.Random(args.seed + i))
+               for i in range(args.clients)]
+    threads = [threading.Thread(target=c.run, args=(deadline,)) for c in clients]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    report = {}
+    for label in sorted(results):
+        if label.endswith(' errors') or label.endswith(' rejected'):
+            continue
+        samples = results[label]
+        report[label] = {'count': len(samples), 'errors': len(results.get(label + ' errors', [])),
+                         'rejected': len(results.get(label + ' rejected', [])),
+                         'rps': len(samples) / args.duration,
+                         'p50_ms': percentile(samples, 0.5) * 1000, 'p99_ms': percentile(samples, 0.99) * 1000}
+        print('{:20} n={count:6d} err={errors:4d} 429={rejected:5d} {rps:8.1f} req/s p50={p50_ms:8.2f}ms '
+              'p99={p99_ms:8.2f}ms'.format(label, **report[label]))
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
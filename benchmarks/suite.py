@@ -0,0 +1,202 @@
+import argparse
+import http.client
+import json
+import os
+import platform
+import sys
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from autoexpanding_map import AutoExpandingMap
+from map import make_height_map, make_type_map
+from rvm import rvm
+
+SEED = 0
+CHUNK_SHAPE = (32, 32)
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+# A benchmark regresses when its time per operation grows by more than this fraction over the baseline.
+DEFAULT_THRESHOLD = 0.25
+# Throughput over loopback sockets is noisier than the in-process benchmarks.
+HTTP_THRESHOLD = 0.5
+
+WANDER_SCRIPT = '''
+def step(ctx):
+    vm = ctx.persistent_context
+    vm.move_direction(direction((vm.frame_count + ctx.actor_id) % 4 + 1), ctx.actor_id)
+    vm.look_direction(direction.N, ctx.actor_id)
+'''
+
+
+def measure(operation, operations, repeats):
+    """Best seconds per operation over several timed runs, as timeit reports, after one untimed warm-up run."""
+    operation()
+    runs = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        operation()
+        runs.append((time.perf_counter() - start) / operations)
+    return min(runs)
+
+
+def bench_height_map(repeats):
+    chunks = [(x, y) for x in range(-4, 4) for y in range(-4, 4)]
+
+    def run():
+        for x, y in chunks:
+            make_height_map(CHUNK_SHAPE, x, y, SEED)
+    return measure(run, len(chunks), repeats)
+
+
+def bench_type_map(repeats):
+    height_maps = [make_height_map(CHUNK_SHAPE, x, y, SEED) for x in range(-4, 4) for y in range(-4, 4)]
+
+    def run():
+        for height_map in height_maps:
+            make_type_map(height_map)
+    return measure(run, len(height_maps), repeats)
+
+
+def bench_render_encode(repeats):
+    world = AutoExpandingMap(CHUNK_SHAPE, SEED)
+    chunks = [(x, y) for x in range(-4, 4) for y in range(-4, 4)]
+    for chunk in chunks:
+        world.get_chunk(chunk)
+
+    def run():
+        for x, y in chunks:
+            cv2.imencode('.jpg', world.render_chunk(x, y))
+    return measure(run, len(chunks), repeats)
+
+
+def bench_step(actors, repeats, steps=5):
+    np.random.seed(SEED)
+    vm = rvm.RVMPersistentContext(seed=SEED)
+    side = int(np.ceil(np.sqrt(actors)))
+    for i in range(actors):
+        vm.add_actor(rvm.RVMScript(WANDER_SCRIPT, 'bench'), (i % side * 3, i // side * 3))
+
+    def run():
+        for _ in range(steps):
+            vm.step()
+    return measure(run, steps, repeats)
+
+
+def bench_http(repeats, clients=8, requests_per_client=200):
+    import main
+
+    np.random.seed(SEED)
+    vm = rvm.RVMPersistentContext(seed=SEED)
+    server = main.make_server(vm, ('127.0.0.1', 0))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+
+    def client(index):
+        connection = http.client.HTTPConnection(host, port, timeout=30)
+
+        def request(method, path, body=None):
+            connection.request(method, path, body=body)
+            response = connection.getresponse()
+            data = response.read()
+            if response.status >= 400 and response.status != 429:
+                raise RuntimeError('{} {} answered {}'.format(method, path, response.status))
+            return data
+
+        actor_id = json.loads(request('POST', '/start/bench{}'.format(index)))['actor_id']
+        paths = ['/self_status/{}'.format(actor_id), '/status/?actor={}'.format(actor_id),
+                 '/chunk/{}/{}'.format(index % 4, index // 4)]
+        move = json.dumps({'act': 'MOVE', 'args': 'UP'})
+        for i in range(requests_per_client):
+            if i % 4 == 3:
+                request('POST', '/action/{}'.format(actor_id), move)
+            else:
+                request('GET', paths[i % 4])
+        connection.close()
+
+    def run():
+        threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    try:
+        return measure(run, clients * (requests_per_client + 1), repeats)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+BENCHMARKS = {
+    'make_height_map': (bench_height_map, DEFAULT_THRESHOLD),
+    'make_type_map': (bench_type_map, DEFAULT_THRESHOLD),
+    'render_encode_jpg': (bench_render_encode, DEFAULT_THRESHOLD),
+    'step_10_actors': (lambda repeats: bench_step(10, repeats), DEFAULT_THRESHOLD),
+    'step_1k_actors': (lambda repeats: bench_step(1000, repeats), DEFAULT_THRESHOLD),
+    'step_10k_actors': (lambda repeats: bench_step(10000, repeats, steps=2), DEFAULT_THRESHOLD),
+    'http_requests': (bench_http, HTTP_THRESHOLD),
+}
+
+
+def environment():
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'opencv': cv2.__version__,
+            'machine': platform.machine(), 'system': platform.system(), 'cpus': os.cpu_count()}
+
+
+def compare(results, baseline):
+    """Yields (name, ratio, threshold) for every benchmark present in both runs, ratio is current/baseline time."""
+    for name, result in results.items():
+        previous = baseline.get('benchmarks', {}).get(name)
+        if previous is None:
+            continue
+        yield name, result['seconds'] / previous['seconds'], result['threshold']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the benchmark suite and compare it with a stored baseline.')
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS), default=None)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--output', default=None, help='write the results to this JSON file')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--threshold', type=float, default=None, help='override every per-benchmark threshold')
+    parser.add_argument('--update-baseline', action='store_true', help='store these results as the new baseline')
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.only or BENCHMARKS:
+        bench, threshold = BENCHMARKS[name]
+        seconds = bench(args.repeats)
+        results[name] = {'seconds': seconds, 'ops_per_second': 1 / seconds,
+                         'threshold': args.threshold if args.threshold is not None else threshold}
+        print('{:20} {:12.6f} ms/op {:12.1f} ops/s'.format(name, seconds * 1000, 1 / seconds))
+    report = {'environment': environment(), 'repeats': args.repeats, 'benchmarks': results}
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        return
+
+    if not os.path.exists(args.baseline):
+        print('no baseline at', args.baseline)
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get('environment') != report['environment']:
+        print('baseline was recorded on a different environment, comparisons are only indicative')
+    regressions = []
+    for name, ratio, threshold in compare(results, baseline):
+        regressed = ratio > 1 + threshold
+        print('{:20} {:6.2f}x baseline time {}'.format(name, ratio, 'REGRESSION' if regressed else 'ok'))
+        if regressed:
+            regressions.append(name)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+import concurrent.futures
+import glob
+import json
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+
+DEFAULT_INTERVAL = 4 * 60
+SNAPSHOT_PATTERN = 'snapshot-{:012d}.npz'
+JOURNAL_PATTERN = 'journal-{:012d}.jsonl'
+
+
+def frame_of(path):
+    return int(os.path.basename(path).split('-')[1].split('.')[0])
+
+
+def snapshots(directory) -> List[str]:
+    return sorted(glob.glob(os.path.join(directory, 'snapshot-*.npz')), key=frame_of)
+
+
+def journals(directory) -> List[str]:
+    return sorted(glob.glob(os.path.join(directory, 'journal-*.jsonl')), key=frame_of)
+
+
+def read_snapshot(path):
+    with np.load(path) as snapshot:
+        arrays = {name: snapshot[name] for name in snapshot.files}
+    return json.loads(str(arrays.pop('meta'))), arrays
+
+
+def stored_seed(directory):
+    found = snapshots(directory) if os.path.isdir(directory) else []
+    if not found:
+        return None
+    return read_snapshot(found[-1])[0]['seed']
+
+
+def capture(vm) -> dict:
+    """Copies everything a snapshot needs, runs on the step thread so it must stay cheap."""
+    actors = vm.actors
+    slots = np.flatnonzero(actors.alive)
+    ids = actors.ids[slots]
+    sources: Dict[str, int] = {}
+    script_index = np.empty(len(slots), dtype=np.int32)
+    states = {}
+    for i, actor_id in enumerate(ids.tolist()):
+        script = vm.actor_scripts[actor_id]
+        script_index[i] = sources.setdefault(script.source, len(sources))
+        # name is in the table and act only lives for the duration of a step.
+        extra = {k: v for k, v in vars(script.state).items() if k not in ('name', 'act')}
+        if extra:
+            # Serialised here, the writer thread must not see scripts change their lists and dicts mid-write.
+            try:
+                states[actor_id] = json.loads(json.dumps(extra))
+            except (TypeError, ValueError) as e:
+                print('got exception', e, 'saving state of actor', actor_id)
+    return {
+        'meta': {'frame': vm.frame_count, 'actor_id_counter': vm.actor_id_counter, 'seed': vm.simulation_map.seed,
+                 'sources': list(sources), 'states': states,
+                 'messages': [[m.timestamp, m.actor_id, m.msg] for m in vm.messages.log]},
+        'ids': ids,
+        'positions': actors.positions[slots],
+        'enabled': actors.enabled[slots],
+        'creation_frame': actors.creation_frame[slots],
+        'names': np.array([actors.names[s] for s in slots.tolist()], dtype=str),
+        'script_index': script_index,
+    }
+
+
+def write_snapshot(directory, state):
+    frame = state['meta']['frame']
+    path = os.path.join(directory, SNAPSHOT_PATTERN.format(frame))
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as f:
+        np.savez(f, **{**state, 'meta': np.array(json.dumps(state['meta']))})
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+    # The new snapshot covers everything before it, older snapshots and journals are no longer needed.
+    for old in snapshots(directory) + journals(directory):
+        if frame_of(old) < frame:
+            os.remove(old)
+    return path
+
+
+def restore(vm, directory) -> Optional[int]:
+    """Loads the latest snapshot into a fresh vm and replays the journals written after it.
+
+    Returns the frame the world resumes at, or None when there is nothing to restore.
+    """
+    from rvm.rvm import RVMScript
+
+    found = snapshots(directory) if os.path.isdir(directory) else []
+    if not found:
+        return None
+    meta, arrays = read_snapshot(found[-1])
+    sources = list(meta['sources'])
+    with vm.lock:
+        vm.actors.advance(meta['frame'])
+        for actor_id, position, enabled, creation_frame, name, index in zip(
+                arrays['ids'].tolist(), arrays['positions'].tolist(), arrays['enabled'].tolist(),
+                arrays['creation_frame'].tolist(), arrays['names'].tolist(), arrays['script_index'].tolist()):
+            script = RVMScript(sources[index], name)
+            for attribute, value in meta['states'].get(str(actor_id), {}).items():
+                setattr(script.state, attribute, value)
+            vm.add_actor(script, position, actor_id, creation_frame)
+            vm.actors[actor_id]['enabled'] = enabled
+        for timestamp, actor_id, msg in meta['messages']:
+            vm.messages.post(actor_id, timestamp, msg)
+        vm.actor_id_counter = max(vm.actor_id_counter, meta['actor_id_counter'])
+        vm.frame_count = meta['frame']
+
+        # Only the last journaled row of each actor matters, it is applied once after the replay.
+        latest: Dict[int, tuple] = {}
+        for path in journals(directory):
+            if frame_of(path) < meta['frame']:
+                continue
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A crash can leave the last line half written, nothing after it was applied either.
+                        print('stopping journal replay at a truncated record in', path)
+                        break
+                    if 'frame' in record:
+                        replay(vm, record, sources, latest)
+                    else:
+                        sources = list(record['sources'])
+        for actor_id, (x, y, enabled, frame) in latest.items():
+            vm.actors.place(actor_id, x, y)
+            slot = vm.actors.slot_of[actor_id]
+            vm.actors.enabled[slot] = enabled
+            vm.actors.changed_frame[slot] = frame
+    return vm.frame_count
+
+
+def replay(vm, record, sources, latest):
+    from rvm.rvm import RVMScript
+
+    frame = record['frame']
+    vm.actors.advance(frame)
+    sources.extend(record.get('sources', ()))
+    for event in record['events']:
+        if event[0] == 'spawn':
+            _, actor_id, name, index, x, y, creation_frame = event
+            vm.add_actor(RVMScript(sources[index], name), (x, y), actor_id, creation_frame)
+        else:
+            vm.remove_actor(event[1])
+            latest.pop(event[1], None)
+    for actor_id, x, y, enabled in record['changed']:
+        latest[actor_id] = (x, y, bool(enabled), frame)
+    for actor_id, msg in record['messages']:
+        vm.messages.post(actor_id, frame, msg)
+    vm.messages.expire(frame)
+    vm.frame_count = frame + 1
+    vm.actors.advance(frame + 1)
+
+
+class Checkpointer:
+    """Keeps a world restorable: a snapshot every interval ticks plus a journal of every tick since.
+
+    The journal records what each tick changed (spawns, removals, moved or toggled actors and new messages),
+    so a restart applies it row by row instead of running every script again. Snapshots are copied on the
+    step thread and written by a background thread, while one is being written the next one is skipped.
+    Scripts are restored from their source, globals given to RVMScript as keyword arguments are not kept.
+    """
+
+    def __init__(self, vm, directory, interval=DEFAULT_INTERVAL):
+        self.vm = vm
+        self.directory = directory
+        self.interval = interval
+        os.makedirs(directory, exist_ok=True)
+        self.executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='checkpoint')
+        self.writing: Optional[concurrent.futures.Future] = None
+        self.journal = None
+        self.sources: Dict[str, int] = {}
+        self.events = []
+        self.snapshots = 0
+        self.last_snapshot_frame = None
+        self.start_segment(wait=True)
+
+    def start_segment(self, wait=False):
+        """Snapshots the world now and starts the journal of the ticks after it."""
+        state = capture(self.vm)
+        frame = state['meta']['frame']
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = open(os.path.join(self.directory, JOURNAL_PATTERN.format(frame)), 'a')
+        # Each journal starts with its own script table, so it still replays if this snapshot never lands.
+        self.sources = {source: i for i, source in enumerate(state['meta']['sources'])}
+        self.journal.write(json.dumps({'sources': list(self.sources)}) + '\n')
+        self.writing = self.executor.submit(self.write, state)
+        self.writing.add_done_callback(self.written)
+        self.last_snapshot_frame = frame
+        if wait:
+            self.writing.result()
+
+    def write(self, state):
+        # Chunks the restored actors stand on reach the disk with the snapshot.
+        self.vm.simulation_map.flush()
+        return write_snapshot(self.directory, state)
+
+    def written(self, future: concurrent.futures.Future):
+        try:
+            future.result()
+            self.snapshots += 1
+        except Exception as e:
+            print('got exception', e, 'writing checkpoint')
+
+    def spawned(self, actor_id, script, position, creation_frame):
+        index = self.sources.get(script.source)
+        new_source = index is None
+        if new_source:
+            index = self.sources[script.source] = len(self.sources)
+        self.events.append(('spawn', actor_id, script.name, index, int(position[0]), int(position[1]),
+                            int(creation_frame), script.source if new_source else None))
+
+    def removed(self, actor_id):
+        self.events.append(('remove', actor_id))
+
+    def tick(self, frame):
+        """Journals everything frame changed, called at the end of each step with the lock held."""
+        actors = self.vm.actors
+        slots = np.flatnonzero(actors.alive & (actors.changed_frame == frame))
+        changed = np.column_stack((actors.ids[slots], actors.positions[slots], actors.enabled[slots])).tolist()
+        events, new_sources = [], []
+        for event in self.events:
+            if event[0] == 'spawn':
+                if event[-1] is not None:
+                    new_sources.append(event[-1])
+                event = event[:-1]
+            events.append(event)
+        self.events = []
+        record = {'frame': frame, 'events': events, 'changed': changed,
+                  'messages': [[m.actor_id, m.msg] for m in self.vm.messages.since(frame)]}
+        if new_sources:
+            record['sources'] = new_sources
+        self.journal.write(json.dumps(record) + '\n')
+        self.journal.flush()
+
+        if frame + 1 - self.last_snapshot_frame >= self.interval and self.writing.done():
+            self.start_segment()
+
+    def stats(self):
+        return {'snapshots': self.snapshots, 'last_snapshot_frame': self.last_snapshot_frame,
+                'writing': not self.writing.done()}
+
+    def shutdown(self):
+        self.executor.shutdown()
+        self.journal.close()
@@ -0,0 +1,77 @@
+from collections import OrderedDict
+from typing import Hashable, Iterable, Optional
+
+from map import SimulationMap
+
+
+def chunk_nbytes(chunk: SimulationMap):
+    return chunk.height_map.nbytes + chunk.type_map.nbytes
+
+
+class ChunkCache:
+    def __init__(self, max_chunks: Optional[int] = None, max_bytes: Optional[int] = None):
+        self.max_chunks = max_chunks
+        self.max_bytes = max_bytes
+        self._chunks: 'OrderedDict[Hashable, SimulationMap]' = OrderedDict()
+        self.pinned = frozenset()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self._chunks
+
+    def __len__(self):
+        return len(self._chunks)
+
+    def __iter__(self):
+        return iter(self._chunks)
+
+    def keys(self):
+        return self._chunks.keys()
+
+    def get(self, key) -> Optional[SimulationMap]:
+        chunk = self._chunks.get(key)
+        if chunk is None:
+            self.misses += 1
+            return None
+        self._chunks.move_to_end(key)
+        self.hits += 1
+        return chunk
+
+    def peek(self, key) -> Optional[SimulationMap]:
+        """Like get, but leaves the LRU order and the hit/miss counters alone."""
+        return self._chunks.get(key)
+
+    def put(self, key, chunk: SimulationMap):
+        previous = self._chunks.pop(key, None)
+        if previous is not None:
+            self.nbytes -= chunk_nbytes(previous)
+        self._chunks[key] = chunk
+        self.nbytes += chunk_nbytes(chunk)
+        self.evict()
+
+    def pin(self, keys: Iterable[Hashable]):
+        self.pinned = frozenset(keys)
+        self.evict()
+
+    def over_budget(self):
+        return (self.max_chunks is not None and len(self._chunks) > self.max_chunks) or \
+               (self.max_bytes is not None and self.nbytes > self.max_bytes)
+
+    def evict(self):
+        # Pinned chunks met at the LRU end are moved to the MRU end, so each pass visits every chunk at most once.
+        for _ in range(len(self._chunks)):
+            if not self.over_budget():
+                return
+            key, chunk = self._chunks.popitem(last=False)
+            if key in self.pinned:
+                self._chunks[key] = chunk
+                continue
+            self.nbytes -= chunk_nbytes(chunk)
+            self.evictions += 1
+
+    def stats(self):
+        return {'chunks': len(self._chunks), 'bytes': self.nbytes, 'pinned': len(self.pinned),
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
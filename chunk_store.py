@@ -0,0 +1,103 @@
+import json
+import os
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import numpy as np
+
+from map import SimulationMap
+
+REGION_SIZE = 16
+# Each open region holds a file descriptor, the least recently used ones are closed beyond this.
+MAX_OPEN_REGIONS = 64
+
+
+def stored_seed(directory):
+    meta_path = os.path.join(directory, 'world.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, 'r') as f:
+        return json.load(f)['seed']
+
+
+class RegionChunkStore:
+    """Chunks stored in region files of REGION_SIZE x REGION_SIZE fixed-size slots, read back through np.memmap."""
+
+    def __init__(self, directory, chunk_shape, seed=None, region_size=REGION_SIZE, max_open=MAX_OPEN_REGIONS):
+        self.directory = directory
+        self.chunk_shape = tuple(chunk_shape)
+        self.region_size = region_size
+        os.makedirs(directory, exist_ok=True)
+        self.seed = self.load_meta(seed)
+        self.slot_dtype = np.dtype([('present', np.uint8),
+                                    ('height_map', np.uint8, self.chunk_shape),
+                                    ('type_map', '<u2', self.chunk_shape)])
+        self.max_open = max_open
+        self.regions: 'OrderedDict[Tuple[int, int], np.memmap]' = OrderedDict()
+
+    def load_meta(self, seed):
+        meta_path = os.path.join(self.directory, 'world.json')
+        meta = {'seed': seed, 'chunk_shape': list(self.chunk_shape), 'region_size': self.region_size}
+        if stored_seed(self.directory) is not None:
+            with open(meta_path, 'r') as f:
+                stored = json.load(f)
+            if seed is not None and stored['seed'] != seed:
+                raise ValueError(f'world store {self.directory} was generated with seed {stored["seed"]}, not {seed}')
+            if stored['chunk_shape'] != meta['chunk_shape'] or stored['region_size'] != self.region_size:
+                raise ValueError(f'world store {self.directory} has an incompatible layout: {stored}')
+            return stored['seed']
+        if seed is None:
+            meta['seed'] = seed = int(np.random.SeedSequence().entropy)
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+        return seed
+
+    def region_path(self, region_index):
+        return os.path.join(self.directory, 'r.{}.{}.bin'.format(*region_index))
+
+    def locate(self, chunk_index):
+        region_x, slot_x = divmod(chunk_index[0], self.region_size)
+        region_y, slot_y = divmod(chunk_index[1], self.region_size)
+        return (region_x, region_y), (slot_x, slot_y)
+
+    def region(self, region_index, create=False) -> Optional[np.memmap]:
+        region = self.regions.get(region_index)
+        if region is not None:
+            self.regions.move_to_end(region_index)
+            return region
+        path = self.region_path(region_index)
+        if not os.path.exists(path):
+            if not create:
+                return None
+            # Sized up front so the file is sparse until slots are written.
+            with open(path, 'wb') as f:
+                f.truncate(self.slot_dtype.itemsize * self.region_size ** 2)
+        region = np.memmap(path, dtype=self.slot_dtype, mode='r+', shape=(self.region_size, self.region_size))
+        self.regions[region_index] = region
+        while len(self.regions) > self.max_open:
+            # Loaded chunks are copies, so dropping the last reference unmaps it and closes its descriptor.
+            self.regions.popitem(last=False)[1].flush()
+        return region
+
+    def __contains__(self, chunk_index):
+        region_index, slot = self.locate(chunk_index)
+        region = self.region(region_index)
+        return region is not None and bool(region['present'][slot])
+
+    def load(self, chunk_index) -> Optional[SimulationMap]:
+        region_index, slot = self.locate(chunk_index)
+        region = self.region(region_index)
+        if region is None or not region['present'][slot]:
+            return None
+        return SimulationMap.from_arrays(region['height_map'][slot].copy(), region['type_map'][slot].copy())
+
+    def save(self, chunk_index, chunk: SimulationMap):
+        region_index, slot = self.locate(chunk_index)
+        region = self.region(region_index, create=True)
+        region['height_map'][slot] = chunk.height_map
+        region['type_map'][slot] = chunk.type_map
+        region['present'][slot] = 1
+
+    def flush(self):
+        for region in list(self.regions.values()):
+            region.flush()
@@ -1,19 +1,105 @@
+import argparse
+import concurrent.futures
+import gzip
 import http.server as hs
 import json
 import socketserver
 import threading
 import time
+import urllib.parse
 from http.server import BaseHTTPRequestHandler
-from typing import Tuple
-
-import cv2
+from typing import Optional, Tuple
 
+import actions
+import checkpoint
+import metrics
+import profiler
+from autoexpanding_map import DEFAULT_MAX_CHUNKS
+from messages import DEFAULT_MAX_PER_ACTOR, DEFAULT_RETENTION
+from pregeneration import BLOCK_SIZE, ChunkPregenerator
 from rvm import rvm
+from scheduler import TickScheduler
+from sharding import ShardedWorld
+from visualization import EncodedImage
+
+KEEP_ALIVE_TIMEOUT = 15
+GZIP_MIN_SIZE = 1024
+GZIP_LEVEL = 5
+CHUNK_FORMATS = {'jpg': 'image/jpeg', 'png': 'image/png'}
+# Chunk URLs do not name the world, and a restart without --seed is a different world at the same coordinates.
+# Clients revalidate every time, an unchanged chunk costs a 304 thanks to its ETag.
+CHUNK_CACHE_CONTROL = 'no-cache'
+STATIC_CACHE_CONTROL = 'public, max-age=3600'
+# A comment line is sent on idle streams this often, so proxies and clients notice dead connections.
+STREAM_HEARTBEAT = 10
+STREAM_CHUNK_RADIUS = 2
+DEFAULT_RENDER_WORKERS = 2
+
+
+ENDPOINTS = ('/status/', '/self_status/', '/chara/', '/chunk/', '/tile/', '/stream/', '/metrics', '/profile', '/start/',
+             '/debug', '/action/', '/actions/')
+
 
+def endpoint_label(path):
+    for endpoint in ENDPOINTS:
+        if path.startswith(endpoint):
+            return endpoint
+    return 'other'
+
+
+def register_context_metrics(vm, scheduler: TickScheduler):
+    registry = metrics.REGISTRY
+    registry.callback('vitanet_ticks_total', 'Simulation steps run.', 'counter', lambda: scheduler.ticks)
+    registry.callback('vitanet_tick_overruns_total', 'Steps that took longer than the tick interval.', 'counter',
+                      lambda: scheduler.overruns)
+    registry.callback('vitanet_ticks_skipped_total', 'Steps dropped after falling behind.', 'counter',
+                      lambda: scheduler.skipped)
+    registry.callback('vitanet_tick_failures_total', 'Steps that raised an exception.', 'counter',
+                      lambda: scheduler.failures)
+    registry.callback('vitanet_tick_drift_seconds', 'Lateness of the last step against its deadline.', 'gauge',
+                      lambda: scheduler.drift)
+    registry.callback('vitanet_stream_subscribers', 'Open /stream/ connections.', 'gauge',
+                      lambda: vm.updates.subscribers)
+    if not isinstance(vm, rvm.RVMPersistentContext):
+        return
+    chunks = vm.simulation_map.chunks
+    registry.callback('vitanet_actors', 'Actors in the world.', 'gauge', lambda: len(vm.actors))
+    registry.callback('vitanet_chunk_cache_hits_total', 'Chunk cache hits.', 'counter', lambda: chunks.hits)
+    registry.callback('vitanet_chunk_cache_misses_total', 'Chunk cache misses.', 'counter', lambda: chunks.misses)
+    registry.callback('vitanet_chunk_cache_evictions_total', 'Chunks evicted from memory.', 'counter',
+                      lambda: chunks.evictions)
+    registry.callback('vitanet_chunk_cache_chunks', 'Chunks resident in memory.', 'gauge', lambda: len(chunks))
+    registry.callback('vitanet_chunk_cache_bytes', 'Bytes of resident chunk arrays.', 'gauge', lambda: chunks.nbytes)
+    registry.callback('vitanet_messages', 'Chat messages retained.', 'gauge', lambda: len(vm.messages))
+    registry.callback('vitanet_messages_dropped_total', 'Chat messages rejected by the per-actor cap.', 'counter',
+                      lambda: vm.messages.dropped)
+    registry.callback('vitanet_actions_rejected_total', 'Actions rejected because a queue was full.', 'counter',
+                      lambda: vm.action_queues.rejected)
+    if vm.checkpointer is not None:
+        checkpointer = vm.checkpointer
+        registry.callback('vitanet_checkpoint_snapshots_total', 'Snapshots written since startup.', 'counter',
+                          lambda: checkpointer.snapshots)
+        registry.callback('vitanet_checkpoint_frame', 'Frame of the latest snapshot.', 'gauge',
+                          lambda: checkpointer.last_snapshot_frame)
+    if vm.pregenerator is not None:
+        pregenerator = vm.pregenerator
+        registry.callback('vitanet_pregeneration_queue_depth', 'Chunk blocks waiting to be pregenerated.', 'gauge',
+                          lambda: len(pregenerator.queue))
+        registry.callback('vitanet_pregeneration_inflight', 'Chunk blocks being pregenerated.', 'gauge',
+                          lambda: len(pregenerator.inflight))
+
+
+def make_handler(vm: rvm.RVMPersistentContext, render_pool: Optional[concurrent.futures.Executor] = None):
+    with open('chara.png', 'rb') as f:
+        chara_image = EncodedImage.of(f.read())
+    profile_lock = threading.Lock()
 
-def make_handler(vm: rvm.RVMPersistentContext):
     class RvmHttpProxyRequestHandler(BaseHTTPRequestHandler):
         protocol_version = 'HTTP/1.1'
+        # Idle keep-alive connections are closed after this many seconds.
+        timeout = KEEP_ALIVE_TIMEOUT
+        # Headers and body are written separately, Nagle would hold the body back on kept-alive connections.
+        disable_nagle_algorithm = True
 
         def __init__(self, request: bytes, client_address: Tuple[str, int], server: socketserver.BaseServer):
             super().__init__(request, client_address, server)
@@ -21,111 +107,231 @@ def make_handler(vm: rvm.RVMPersistentContext):
         def log_message(self, format, *args):
             pass
 
+        def send_response(self, code, message=None):
+            self.response_code = code
+            super().send_response(code, message)
+
+        def instrumented(self, method, handle):
+            endpoint = endpoint_label(self.path)
+            self.response_code = None
+            start = time.perf_counter()
+            try:
+                handle()
+            finally:
+                # Streams stay open for as long as the client listens, their duration says nothing about latency.
+                if endpoint != '/stream/':
+                    metrics.REQUEST_SECONDS.observe(time.perf_counter() - start, method=method, endpoint=endpoint)
+                metrics.RESPONSES.inc(method=method, endpoint=endpoint, code=self.response_code)
+
         def do_GET(self):
-            if self.path == '/status/':
-                self.send_response(200)
-                self.send_header('Content-Type', 'application/json')
+            self.instrumented('GET', self.handle_get)
+
+        def do_POST(self):
+            self.instrumented('POST', self.handle_post)
+
+        def read_body(self):
+            length = int(self.headers.get('content-length') or 0)
+            return self.rfile.read(length) if length > 0 else b''
+
+        def send_body(self, code, content_type, body: bytes, extra_headers=()):
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            for header, value in extra_headers:
+                self.send_header(header, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_json(self, code, obj):
+            body = json.dumps(obj).encode('ascii')
+            extra_headers = [('Vary', 'Accept-Encoding')]
+            if len(body) >= GZIP_MIN_SIZE and 'gzip' in self.headers.get('Accept-Encoding', ''):
+                body = gzip.compress(body, compresslevel=GZIP_LEVEL)
+                extra_headers.append(('Content-Encoding', 'gzip'))
+            self.send_body(code, 'application/json', body, extra_headers)
+
+        def send_image(self, image: EncodedImage, content_type, cache_control):
+            headers = [('ETag', image.etag), ('Cache-Control', cache_control)]
+            if image.matches(self.headers.get('If-None-Match')):
+                self.send_response(304)
+                for header, value in headers:
+                    self.send_header(header, value)
                 self.end_headers()
-                self.wfile.write(
-                    (json.dumps({'actors': vm.actors,
-                                 'chunkpos': {
-                                     k: [[p // vm.simulation_map.chunk_x, p % vm.simulation_map.chunk_x] for p in
-                                         vm.actors[k]['position']] for
-                                     k in vm.actors},
-                                 'world_frame': vm.frame_count})).encode('ascii'))
-                self.close_connection = True
-            elif self.path.startswith('/self_status/'):
-                *args, user_id = self.path.split('/')
+            else:
+                self.send_body(200, content_type, image.data, headers)
+
+        def chunk_image(self, chunk_x, chunk_y, ext):
+            # Cache hits are answered directly, rendering and generation go through the bounded pool
+            # so they cannot starve the threads serving the cheap JSON endpoints.
+            image = vm.simulation_map.cached_image(chunk_x, chunk_y, ext)
+            if image is not None:
+                return image
+            if render_pool is None:
+                return vm.simulation_map.encoded_chunk(chunk_x, chunk_y, ext)
+            return render_pool.submit(vm.simulation_map.encoded_chunk, chunk_x, chunk_y, ext).result()
+
+        def tile_image(self, z, tile_x, tile_y, ext):
+            image = vm.simulation_map.cached_tile(z, tile_x, tile_y, ext)
+            if image is not None:
+                return image
+            if render_pool is None:
+                return vm.simulation_map.encoded_tile(z, tile_x, tile_y, ext)
+            return render_pool.submit(vm.simulation_map.encoded_tile, z, tile_x, tile_y, ext).result()
+
+        def send_event(self, event, obj):
+            self.wfile.write('event: {}\ndata: {}\n\n'.format(event, json.dumps(obj)).encode('ascii'))
+            self.wfile.flush()
+
+        def stream_updates(self, actor_id, radius):
+            """Server-sent events with one area-of-interest delta per tick the client keeps up with."""
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.close_connection = True
+            vm.updates.subscribe()
+            try:
+                since = None
+                announced = set()
+                while True:
+                    update = vm.delta_status(actor_id, since, radius)
+                    if 'error' in update:
+                        self.send_event('error', update)
+                        return
+                    nearby = set(vm.chunks_near(actor_id, STREAM_CHUNK_RADIUS))
+                    update['chunks'] = sorted(nearby - announced)
+                    announced = nearby
+                    if since is None or update['actors'] or update['messages'] or update['despawned'] or \
+                            update['chunks']:
+                        self.send_event('update', update)
+                    since = update['world_frame']
+                    while vm.updates.wait_after(since, STREAM_HEARTBEAT) is None:
+                        self.wfile.write(b': heartbeat\n\n')
+                        self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError, TimeoutError):
+                pass
+            finally:
+                vm.updates.unsubscribe()
+
+        def send_profile(self, seconds, thread_name):
+            thread = profiler.find_thread(thread_name)
+            if thread is None:
+                self.send_json(400, {'error': 'no thread named {}'.format(thread_name)})
+                return
+            if not profile_lock.acquire(blocking=False):
+                self.send_json(409, {'error': 'a profile is already being captured'})
+                return
+            try:
+                stacks = profiler.sample_thread(thread.ident, seconds)
+            finally:
+                profile_lock.release()
+            self.send_body(200, 'text/plain; charset=utf-8', profiler.folded(stacks).encode('utf-8'))
+
+        def handle_get(self):
+            url = urllib.parse.urlsplit(self.path)
+            query = urllib.parse.parse_qs(url.query)
+            if url.path == '/metrics':
+                self.send_body(200, 'text/plain; version=0.0.4; charset=utf-8',
+                               metrics.REGISTRY.render().encode('utf-8'))
+            elif url.path == '/profile':
+                self.send_profile(float(query.get('seconds', ['5'])[0]), query.get('thread', ['step'])[0])
+            elif url.path.startswith('/stream/'):
+                *args, actor_id = url.path.split('/')
+                self.stream_updates(int(actor_id), int(query.get('radius', [rvm.AOI_RADIUS])[0]))
+            elif url.path == '/status/':
+                since = int(query['since'][0]) if 'since' in query else None
+                radius = int(query.get('radius', [rvm.AOI_RADIUS])[0])
+                if 'actor' in query:
+                    self.send_json(200, vm.delta_status(int(query['actor'][0]), since, radius))
+                elif 'x' in query and 'y' in query:
+                    self.send_json(200, vm.delta_around(int(query['x'][0]), int(query['y'][0]), radius, since))
+                else:
+                    self.send_json(200, vm.world_status())
+            elif url.path.startswith('/self_status/'):
+                *args, user_id = url.path.split('/')
                 user_id = int(user_id)
-                status = vm.status_of(user_id)
-                self.send_response(200)
-                self.send_header('Content-Type', 'application/json')
-                self.end_headers()
-                self.wfile.write(
-                    json.dumps(status).encode('ascii')
-                )
-                self.close_connection = True
-            elif self.path == "/chara/":
-                self.send_response(200)
-                self.send_header('Content-Type', 'image/png')
-                self.end_headers()
-                with open('chara.png', 'rb') as f:
-                    self.wfile.write(f.read())
-                self.close_connection = True
-            elif self.path.startswith("/chunk/"):
-                *args, chunk_x, chunk_y = self.path.split("/")
+                self.send_json(200, vm.status_of(user_id))
+            elif url.path == "/chara/":
+                self.send_image(chara_image, 'image/png', STATIC_CACHE_CONTROL)
+            elif url.path.startswith("/chunk/"):
+                *args, chunk_x, chunk_y = url.path.split("/")
                 chunk_x = int(chunk_x)
                 chunk_y = int(chunk_y)
-                chunk_image = vm.simulation_map.render_chunk(chunk_x, chunk_y)
-                succ, enc = cv2.imencode(".jpg", chunk_image)
-                if succ:
-                    self.send_response(200)
-                    image_bytes = enc.tobytes()
-                    self.send_header('Content-Type', 'image/jpeg')
-                    self.end_headers()
-                    self.wfile.write(image_bytes)
-                    self.close_connection = True
+                image_format = query.get('format', ['jpg'])[0]
+                if image_format not in CHUNK_FORMATS:
+                    self.send_json(400, {'error': 'unknown image format'})
+                    return
+                image = self.chunk_image(chunk_x, chunk_y, '.' + image_format)
+                if image is not None:
+                    self.send_image(image, CHUNK_FORMATS[image_format], CHUNK_CACHE_CONTROL)
                 else:
-                    self.send_response(400)
-                    self.send_header('Content-Type', 'application/json')
-                    self.end_headers()
-                    self.wfile.write(json.dumps({'error': 'failed to encode image'}).encode("ascii"))
-                    self.close_connection = True
+                    self.send_json(400, {'error': 'failed to encode image'})
+            elif url.path.startswith("/tile/"):
+                *args, z, tile_x, tile_y = url.path.split("/")
+                z = int(z)
+                image_format = query.get('format', ['jpg'])[0]
+                if image_format not in CHUNK_FORMATS:
+                    self.send_json(400, {'error': 'unknown image format'})
+                    return
+                if not 0 <= z <= vm.simulation_map.max_tile_level:
+                    self.send_json(400, {'error': 'zoom level out of range'})
+                    return
+                image = self.tile_image(z, int(tile_x), int(tile_y), '.' + image_format)
+                if image is not None:
+                    self.send_image(image, CHUNK_FORMATS[image_format], CHUNK_CACHE_CONTROL)
+                else:
+                    self.send_json(400, {'error': 'failed to encode image'})
             else:
-                self.send_response(400)
-                self.send_header('Content-Type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps({
+                self.send_json(400, {
                     'error': 'path not found'
-                }).encode('ascii'))
-                self.close_connection = True
+                })
 
-        def do_POST(self):
+        def handle_post(self):
+            # The body is always consumed so a keep-alive connection stays in sync.
+            indata = self.read_body()
             if self.path.startswith('/start/'):
                 user = self.path.split('/')[-1]
-                self.send_response(201)
-                self.send_header('Content-Type', 'application/json')
-                self.end_headers()
                 user_id = vm.create_player(user)
-                self.wfile.write(json.dumps({'actor_id': user_id}).encode('ascii'))
-                self.close_connection = True
+                self.send_json(201, {'actor_id': user_id})
             elif self.path == "/debug":
-                indata = self.rfile.read(int(self.headers.get('content-length')))
                 print('got debug', indata)
-                self.send_response(200)
-                self.send_header("Content-Type", "application/json")
-                self.end_headers()
-                self.wfile.write("{}".encode())
-                self.close_connection = True
+                self.send_json(200, {})
             elif self.path.startswith('/action/'):
                 user_id = int(self.path.split('/')[-1])
-                if user_id in vm.actor_scripts:
-                    indata = self.rfile.read(int(self.headers.get('content-length')))
-                    action_object = json.loads(indata)
-                    self.send_response(201)
-                    self.send_header('Content-Type', 'application/json')
-                    self.end_headers()
-                    vm.actor_scripts[user_id].environment['act'] = action_object
-                    self.wfile.write(json.dumps({
+                action_object = json.loads(indata)
+                result = vm.enqueue_action(user_id, action_object)
+                if result == actions.ACCEPTED:
+                    self.send_json(201, {
                         'actor_id': user_id,
-                        'action': vm.actor_scripts[user_id].environment['act']
-                    }).encode('ascii'))
+                        'action': action_object
+                    })
+                elif result == actions.QUEUE_FULL:
+                    self.send_json(429, {
+                        'error': 'too many pending actions'
+                    })
                 else:
-                    self.send_response(400)
-                    self.send_header('Content-Type', 'application/json')
-                    self.end_headers()
-                    self.wfile.write(json.dumps({
+                    self.send_json(400, {
                         'error': 'user not found'
-                    }).encode('ascii'))
-                self.close_connection = True
+                    })
+            elif self.path == '/actions/':
+                # {"actions": [{"actor_id": 1, "action": {"act": "MOVE", "args": "UP"}}, ...]}
+                # Every entry is checked before any is queued, a bad batch queues nothing.
+                try:
+                    batch = [(int(entry['actor_id']), entry['action']) for entry in json.loads(indata)['actions']]
+                except (ValueError, TypeError, KeyError) as e:
+                    self.send_json(400, {'error': 'malformed batch: {!r}'.format(e)})
+                    return
+                results = []
+                for actor_id, action in batch:
+                    result = vm.enqueue_action(actor_id, action)
+                    results.append({'actor_id': actor_id, 'accepted': result == actions.ACCEPTED,
+                                    **({} if result == actions.ACCEPTED else {'error': result})})
+                self.send_json(201, {'results': results})
             else:
-                self.send_response(400)
-                self.send_header('Content-Type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps({
+                self.send_json(400, {
                     'error': 'path not found'
-                }).encode('ascii'))
-                self.close_connection = True
+                })
 
     return RvmHttpProxyRequestHandler
 
@@ -137,31 +343,102 @@ def load_script(path, name):
     return rvm.RVMScript(script_content, name)
 
 
+def make_server(vm: rvm.RVMPersistentContext, address=('0.0.0.0', 4242), render_workers=DEFAULT_RENDER_WORKERS):
+    render_pool = concurrent.futures.ThreadPoolExecutor(render_workers, thread_name_prefix='render')
+    return hs.ThreadingHTTPServer(address, make_handler(vm, render_pool))
+
+
 def main():
-    vm = rvm.RVMPersistentContext()
-    httpserver = hs.HTTPServer(('0.0.0.0', 4242), make_handler(vm))
-    http_thread = threading.Thread(target=httpserver.serve_forever)
-
-    step_time = time.monotonic()
-
-    def step_thread():
-        nonlocal step_time
-        while True:
-            curr_time = time.monotonic()
-            timediff = curr_time - step_time
-            if timediff > 0.25:
-                while timediff > 0.25:
-                    vm.step()
-                    timediff -= 0.25
-                step_time = curr_time
-            time.sleep(0)
-
-    rvm_update = threading.Thread(target=step_thread)
+    parser = argparse.ArgumentParser(description='Vitanet server')
+    parser.add_argument('--seed', type=int, default=None, help='world seed, random if omitted')
+    parser.add_argument('--max-chunks', type=int, default=DEFAULT_MAX_CHUNKS,
+                        help='number of chunks kept in memory before least recently used ones are evicted')
+    parser.add_argument('--max-chunk-mb', type=float, default=None, help='memory budget for resident chunks')
+    parser.add_argument('--pin-radius', type=int, default=1,
+                        help='chunks within this many chunks of an actor are never evicted')
+    parser.add_argument('--world-dir', default=None,
+                        help='directory of the on-disk chunk store, chunks are only kept in memory if omitted')
+    parser.add_argument('--pregen-radius', type=int, default=2,
+                        help='chunks within this many chunks of an actor are generated ahead of time')
+    parser.add_argument('--pregen-workers', type=int, default=2,
+                        help='processes used for chunk pregeneration, 0 disables it')
+    parser.add_argument('--pregen-block', type=int, default=BLOCK_SIZE,
+                        help='chunks are pregenerated in blocks of this many chunks per side')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=4242)
+    parser.add_argument('--render-workers', type=int, default=DEFAULT_RENDER_WORKERS,
+                        help='threads rendering and generating chunks for /chunk/ requests')
+    parser.add_argument('--tick-rate', type=float, default=4.0, help='simulation steps per second')
+    parser.add_argument('--max-catch-up', type=int, default=4,
+                        help='most steps run back to back after falling behind, older ones are dropped')
+    parser.add_argument('--message-retention', type=int, default=DEFAULT_RETENTION,
+                        help='frames a chat message stays visible')
+    parser.add_argument('--max-messages-per-actor', type=int, default=DEFAULT_MAX_PER_ACTOR,
+                        help='further messages are dropped while an actor has this many visible ones')
+    parser.add_argument('--max-pending-actions', type=int, default=actions.DEFAULT_MAX_PENDING,
+                        help='actions queued per actor before further ones are rejected')
+    parser.add_argument('--actions-per-tick', type=int, default=actions.DEFAULT_ACTIONS_PER_TICK,
+                        help='queued actions applied per actor each step')
+    parser.add_argument('--shards', type=int, default=0,
+                        help='step the world in this many worker processes, each owning part of the map. '
+                             'Pregeneration is not available with shards')
+    parser.add_argument('--checkpoint-dir', default=None,
+                        help='directory of actor snapshots and the tick journal, the world is restored from it '
+                             'on startup. Actors only live in memory if omitted')
+    parser.add_argument('--checkpoint-interval', type=float, default=60.0, help='seconds between snapshots')
+    args = parser.parse_args()
+    if args.shards > 0 and args.checkpoint_dir is not None:
+        parser.error('--checkpoint-dir is not available with --shards')
+
+    options = dict(message_retention=args.message_retention, max_messages_per_actor=args.max_messages_per_actor,
+                   max_pending_actions=args.max_pending_actions, actions_per_tick=args.actions_per_tick,
+                   max_chunks=args.max_chunks,
+                   max_bytes=int(args.max_chunk_mb * 2 ** 20) if args.max_chunk_mb else None,
+                   pin_radius=args.pin_radius, store_directory=args.world_dir)
+    if args.shards > 0:
+        vm = ShardedWorld(args.shards, seed=args.seed, **options)
+    else:
+        seed = args.seed
+        if args.checkpoint_dir is not None:
+            # A checkpointed world keeps its seed, the actors in it stand on that terrain.
+            stored = checkpoint.stored_seed(args.checkpoint_dir)
+            if seed is not None and stored is not None and stored != seed:
+                raise ValueError(f'checkpoint {args.checkpoint_dir} was saved with seed {stored}, not {seed}')
+            seed = stored if stored is not None else seed
+        vm = rvm.RVMPersistentContext(seed=seed, **options)
+        if args.checkpoint_dir is not None:
+            start = time.perf_counter()
+            frame = checkpoint.restore(vm, args.checkpoint_dir)
+            if frame is not None:
+                print('restored {} actors at frame {} in {:.2f}s'.format(len(vm.actors), frame,
+                                                                         time.perf_counter() - start))
+            vm.checkpointer = checkpoint.Checkpointer(vm, args.checkpoint_dir,
+                                                      max(1, round(args.checkpoint_interval * args.tick_rate)))
+        if args.pregen_workers > 0:
+            vm.pregenerator = ChunkPregenerator(vm.simulation_map, args.pregen_radius, args.pregen_workers,
+                                               block_size=args.pregen_block)
+    httpserver = make_server(vm, (args.host, args.port), args.render_workers)
+    http_thread = threading.Thread(target=httpserver.serve_forever, name='http')
+
+    scheduler = TickScheduler(vm.step, args.tick_rate, args.max_catch_up)
+    register_context_metrics(vm, scheduler)
+    rvm_update = threading.Thread(target=scheduler.run, name='step')
 
     rvm_update.start()
     http_thread.start()
-    while True:
-        time.sleep(0)
-
+    try:
+        rvm_update.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        scheduler.stop()
+        httpserver.shutdown()
+        rvm_update.join()
+        http_thread.join()
+        if args.shards > 0:
+            vm.stop()
+        else:
+            vm.simulation_map.flush()
 
-main()
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,6 @@
 import enum
+import functools
+from typing import Dict, Tuple
 
 import numpy as np
 from scipy import ndimage
@@ -49,11 +51,37 @@ def lerp(a, b, x):
     return a + x * (b - a)
 
 
+# grad() is linear in (x, y, z) for a fixed hash, so each of the 16 gradients
+# is fully described by its coefficients on the three axes.
+GRAD_X = np.array([grad(h, 1, 0, 0) for h in range(16)], dtype=np.float64)
+GRAD_Y = np.array([grad(h, 0, 1, 0) for h in range(16)], dtype=np.float64)
+GRAD_Z = np.array([grad(h, 0, 0, 1) for h in range(16)], dtype=np.float64)
+
+
+def grad_array(hashin, x, y, z):
+    h = hashin & 15
+    return GRAD_X[h] * x + GRAD_Y[h] * y + GRAD_Z[h] * z
+
+
+def world_seed_sequence(seed, *key):
+    # SeedSequence only takes non-negative entropy, negative values (chunk coordinates) are wrapped to 64 bits.
+    return np.random.SeedSequence([int(k) if k >= 0 else int(k) & 0xFFFFFFFFFFFFFFFF for k in (seed, *key)])
+
+
+def chunk_rng(seed, chunk_x, chunk_y):
+    return np.random.default_rng(world_seed_sequence(seed, chunk_x, chunk_y))
+
+
 class Perlin:
-    def __init__(self):
+    def __init__(self, seed=None):
+        if seed is None:
+            table = PERMUTATION_TABLE
+        else:
+            table = np.random.default_rng(world_seed_sequence(seed)).permutation(256).tolist()
         self.p = []
         for i in range(512):
-            self.p.append(PERMUTATION_TABLE[i % 256])
+            self.p.append(table[i % 256])
+        self.permutation = np.array(self.p, dtype=np.intp)
 
     def perlinhash(self, xi, yi, zi):
         aaa = self.p[self.p[self.p[xi] + yi] + zi]
@@ -102,17 +130,100 @@ class Perlin:
         y2 = lerp(x1, x2, v)
         return (lerp(y1, y2, w) + 1) / 2
 
+    def noise3d_array(self, x, y, z):
+        x, y, z = np.broadcast_arrays(np.asarray(x, dtype=np.float64),
+                                      np.asarray(y, dtype=np.float64),
+                                      np.asarray(z, dtype=np.float64))
+        p = self.permutation
+
+        floorX = np.floor(x)
+        Xi = floorX.astype(np.intp) & 255
 
-def make_height_map(shape, xM, yM):
-    map_array = np.zeros(shape, dtype=np.float32)
+        floorY = np.floor(y)
+        Yi = floorY.astype(np.intp) & 255
 
-    perlin = Perlin()
+        floorZ = np.floor(z)
+        Zi = floorZ.astype(np.intp) & 255
+
+        xf = x - floorX
+        yf = y - floorY
+        zf = z - floorZ
+
+        u = fade(xf)
+        v = fade(yf)
+        w = fade(zf)
+
+        a = p[Xi] + Yi
+        b = p[Xi + 1] + Yi
+        aa = p[a] + Zi
+        ab = p[a + 1] + Zi
+        ba = p[b] + Zi
+        bb = p[b + 1] + Zi
+
+        x1 = lerp(grad_array(p[aa], xf, yf, zf), grad_array(p[ba], xf - 1, yf, zf), u)
+        x2 = lerp(grad_array(p[ab], xf, yf - 1, zf), grad_array(p[bb], xf - 1, yf - 1, zf), u)
+
+        y1 = lerp(x1, x2, v)
 
-    for x in range(shape[0]):
-        for y in range(shape[1]):
-            map_array[x, y] = sum(perlin.noise3d((x / 4) + (xM * (shape[0] / 4)),
-                                                 (y / 4) + (yM * (shape[1] / 4)),
-                                                 np.random.random_sample()) for i in range(5)) / 5
+        x1 = lerp(grad_array(p[aa + 1], xf, yf, zf - 1),
+                  grad_array(p[ba + 1], xf - 1, yf, zf - 1),
+                  u)
+
+        x2 = lerp(grad_array(p[ab + 1], xf, yf - 1, zf - 1),
+                  grad_array(p[bb + 1], xf - 1, yf - 1, zf - 1),
+                  u)
+
+        y2 = lerp(x1, x2, v)
+        return (lerp(y1, y2, w) + 1) / 2
+
+
+HEIGHT_MAP_SAMPLES = 5
+
+
+@functools.lru_cache(maxsize=8)
+def seeded_perlin(seed):
+    return Perlin(seed)
+
+
+def make_height_map(shape, xM, yM, seed=None):
+    return make_height_block(shape, xM, yM, 1, 1, seed)
+
+
+def chunk_samples(shape, chunk_x, chunk_y, seed=None):
+    if seed is None:
+        return np.random.random_sample((HEIGHT_MAP_SAMPLES,) + tuple(shape))
+    return chunk_rng(seed, chunk_x, chunk_y).random((HEIGHT_MAP_SAMPLES,) + tuple(shape))
+
+
+def make_height_block(shape, chunk_x, chunk_y, width, height, seed=None, halo=0):
+    """Heights of a width x height block of chunks starting at (chunk_x, chunk_y), stitched into one array.
+
+    The block is padded with halo tiles taken from the neighbouring chunks, which get the same
+    heights as when those chunks are generated themselves.
+    """
+    perlin = Perlin() if seed is None else seeded_perlin(seed)
+    sx, sy = shape
+    x0, y0 = chunk_x * sx - halo, chunk_y * sy - halo
+    x1, y1 = (chunk_x + width) * sx + halo, (chunk_y + height) * sy + halo
+
+    zs = np.empty((HEIGHT_MAP_SAMPLES, x1 - x0, y1 - y0))
+    for cx in range(x0 // sx, (x1 - 1) // sx + 1):
+        for cy in range(y0 // sy, (y1 - 1) // sy + 1):
+            # Only the part of a neighbour inside the halo is evaluated, but its whole sample stream is drawn.
+            ax, bx = max(cx * sx, x0), min((cx + 1) * sx, x1)
+            ay, by = max(cy * sy, y0), min((cy + 1) * sy, y1)
+            samples = chunk_samples(shape, cx, cy, seed)
+            zs[:, ax - x0:bx - x0, ay - y0:by - y0] = samples[:, ax - cx * sx:bx - cx * sx, ay - cy * sy:by - cy * sy]
+
+    xs = np.arange(x0, x1) / 4
+    ys = np.arange(y0, y1) / 4
+
+    # Noise is evaluated in strips of about one chunk, its temporaries stay in cache instead of growing with the block.
+    map_array = np.empty((x1 - x0, y1 - y0), dtype=np.float32)
+    rows = max(1, sx * sy // (y1 - y0))
+    for a in range(0, x1 - x0, rows):
+        samples = perlin.noise3d_array(xs[None, a:a + rows, None], ys[None, None, :], zs[:, a:a + rows])
+        map_array[a:a + rows] = samples.sum(axis=0) / HEIGHT_MAP_SAMPLES
     return (map_array * 240).astype(np.uint8)
 
 
@@ -141,9 +252,37 @@ def make_type_map(height_map):
     return type_array
 
 
+# How far make_type_map looks around a tile, classifying a chunk needs this many tiles of its neighbours.
+TYPE_MAP_HALO = 4
+
+
+def make_chunk_block(shape, chunk_x, chunk_y, width=1, height=1, seed=None) -> Dict[Tuple[int, int], 'SimulationMap']:
+    """Generates a block of chunks at once, classified together so coastlines continue across chunk borders."""
+    halo = TYPE_MAP_HALO
+    height_block = make_height_block(shape, chunk_x, chunk_y, width, height, seed, halo)
+    type_block = make_type_map(height_block)[halo:-halo, halo:-halo]
+    height_block = height_block[halo:-halo, halo:-halo]
+    sx, sy = shape
+    chunks = {}
+    for i in range(width):
+        for j in range(height):
+            tiles = np.s_[i * sx:(i + 1) * sx, j * sy:(j + 1) * sy]
+            chunks[(chunk_x + i, chunk_y + j)] = SimulationMap.from_arrays(height_block[tiles].copy(),
+                                                                           type_block[tiles].copy())
+    return chunks
+
+
 class SimulationMap:
-    def __init__(self, shape, x, y):
-        self.height_map = make_height_map(shape, x, y)
-        self.type_map = make_type_map(self.height_map)
+    def __init__(self, shape, x, y, seed=None):
+        chunk = make_chunk_block(shape, x, y, seed=seed)[(x, y)]
+        self.height_map = chunk.height_map
+        self.type_map = chunk.type_map
+
+    @classmethod
+    def from_arrays(cls, height_map, type_map):
+        chunk = cls.__new__(cls)
+        chunk.height_map = height_map
+        chunk.type_map = type_map
+        return chunk
 
 
@@ -0,0 +1,73 @@
+from collections import deque
+from typing import Deque, Dict, List, NamedTuple
+
+DEFAULT_RETENTION = 4 * 15
+DEFAULT_MAX_PER_ACTOR = 16
+DEFAULT_CAPACITY = 16384
+
+
+class Message(NamedTuple):
+    timestamp: int
+    actor_id: int
+    msg: object
+
+    def to_dict(self):
+        return {'timestamp': self.timestamp, 'msg': self.msg}
+
+
+class MessageLog:
+    """Time-ordered message buffer, expired from the head only.
+
+    Each actor's messages are also kept in their own deque, in the same order, so
+    expiring the global head always pops the head of exactly one actor deque.
+    """
+
+    def __init__(self, retention=DEFAULT_RETENTION, max_per_actor=DEFAULT_MAX_PER_ACTOR, capacity=DEFAULT_CAPACITY):
+        self.retention = retention
+        self.max_per_actor = max_per_actor
+        self.capacity = capacity
+        self.log: Deque[Message] = deque()
+        self.by_actor: Dict[int, Deque[Message]] = {}
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.log)
+
+    def post(self, actor_id, timestamp, msg):
+        actor_messages = self.by_actor.setdefault(actor_id, deque())
+        if len(actor_messages) >= self.max_per_actor:
+            self.dropped += 1
+            return False
+        if len(self.log) >= self.capacity:
+            self.pop_oldest()
+        message = Message(timestamp, actor_id, msg)
+        self.log.append(message)
+        actor_messages.append(message)
+        return True
+
+    def pop_oldest(self):
+        message = self.log.popleft()
+        actor_messages = self.by_actor[message.actor_id]
+        actor_messages.popleft()
+        if not actor_messages:
+            del self.by_actor[message.actor_id]
+
+    def expire(self, frame):
+        while self.log and frame - self.log[0].timestamp >= self.retention:
+            self.pop_oldest()
+
+    def of(self, actor_id) -> List[dict]:
+        return [m.to_dict() for m in self.by_actor.get(actor_id, ())]
+
+    def since(self, frame) -> List[Message]:
+        newer = []
+        for message in reversed(self.log):
+            if message.timestamp < frame:
+                break
+            newer.append(message)
+        newer.reverse()
+        return newer
+
+    def drop_actor(self, actor_id):
+        if self.by_actor.pop(actor_id, None) is not None:
+            self.log = deque(m for m in self.log if m.actor_id != actor_id)
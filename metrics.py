@@ -0,0 +1,145 @@
+import bisect
+import threading
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def format_labels(names: Sequence[str], values: Tuple, extra: str = ''):
+    pairs = ['{}="{}"'.format(n, str(v).replace('\\', '\\\\').replace('"', '\\"')) for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help, label_names: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+
+    def key(self, labels: Dict[str, object]):
+        return tuple(labels.get(n, '') for n in self.label_names)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.kind)]
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+    def samples(self):
+        return []
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, help, label_names=()):
+        super().__init__(name, help, label_names)
+        self.values: Dict[Tuple, float] = {}
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            items = list(self.values.items())
+        return ['{}{} {}'.format(self.name, format_labels(self.label_names, k), v) for k, v in items]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, label_names=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, label_names)
+        self.buckets = tuple(buckets)
+        # Per label set: [count per bucket (+Inf last), sum]
+        self.values: Dict[Tuple, list] = {}
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def samples(self):
+        with self.lock:
+            items = [(k, list(counts), total) for k, (counts, total) in self.values.items()]
+        lines = []
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="{}"'.format('+Inf' if bound == float('inf') else bound)
+                lines.append('{}_bucket{} {}'.format(self.name, format_labels(self.label_names, key, le), cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, format_labels(self.label_names, key), total))
+            lines.append('{}_count{} {}'.format(self.name, format_labels(self.label_names, key), cumulative))
+        return lines
+
+
+class CallbackMetric(Metric):
+    """Value read from elsewhere when metrics are rendered, so nothing is paid on the hot path."""
+
+    def __init__(self, name, help, kind, read: Callable[[], object]):
+        super().__init__(name, help)
+        self.kind = kind
+        self.read = read
+
+    def samples(self):
+        return ['{} {}'.format(self.name, self.read())]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric: Metric):
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None and type(existing) is type(metric) and not isinstance(metric, CallbackMetric):
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help, label_names=()) -> Counter:
+        return self.register(Counter(name, help, label_names))
+
+    def histogram(self, name, help, label_names=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, label_names, buckets))
+
+    def callback(self, name, help, kind, read: Callable[[], object]) -> CallbackMetric:
+        return self.register(CallbackMetric(name, help, kind, read))
+
+    def get(self, name) -> Optional[Metric]:
+        return self.metrics.get(name)
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return '\n'.join(m.render() for m in metrics) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+TICK_SECONDS = REGISTRY.histogram('vitanet_tick_seconds', 'Duration of a simulation step.')
+SCRIPT_SECONDS = REGISTRY.histogram('vitanet_script_seconds', 'Duration of one actor script call.', ('phase',),
+                                    buckets=(0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1))
+SCRIPT_ERRORS = REGISTRY.counter('vitanet_script_errors_total', 'Exceptions raised by actor scripts.', ('phase',))
+CHUNK_GENERATE_SECONDS = REGISTRY.histogram('vitanet_chunk_generate_seconds', 'Time to generate one chunk.',
+                                            ('source',))
+CHUNK_RENDER_SECONDS = REGISTRY.histogram('vitanet_chunk_render_seconds', 'Time to render one chunk image.')
+CHUNK_ENCODE_SECONDS = REGISTRY.histogram('vitanet_chunk_encode_seconds', 'Time to encode one chunk image.',
+                                          ('format',))
+IMAGE_CACHE_LOOKUPS = REGISTRY.counter('vitanet_image_cache_lookups_total', 'Encoded chunk image cache lookups.',
+                                       ('result',))
+REQUEST_SECONDS = REGISTRY.histogram('vitanet_request_seconds', 'HTTP request latency.', ('method', 'endpoint'))
+RESPONSES = REGISTRY.counter('vitanet_responses_total', 'HTTP responses sent.', ('method', 'endpoint', 'code'))
@@ -0,0 +1,169 @@
+import concurrent.futures
+import math
+import multiprocessing
+import os
+import time
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from map import SimulationMap, make_chunk_block
+from metrics import CHUNK_GENERATE_SECONDS
+
+DIRECTION_WEIGHT = 1.5
+# Chunks are generated in aligned blocks of BLOCK_SIZE x BLOCK_SIZE, one worker task per block.
+BLOCK_SIZE = 4
+RECHECK_TICKS = 16
+
+
+def generate_chunks(shape, chunk_x, chunk_y, width, height, seed):
+    chunks = make_chunk_block(shape, chunk_x, chunk_y, width, height, seed)
+    return [(chunk_index, chunk.height_map, chunk.type_map) for chunk_index, chunk in chunks.items()]
+
+
+class ChunkPregenerator:
+    def __init__(self, simulation_map, radius=2, workers: Optional[int] = None, max_inflight: Optional[int] = None,
+                 block_size=BLOCK_SIZE):
+        self.simulation_map = simulation_map
+        self.radius = radius
+        self.block_size = block_size
+        workers = workers or os.cpu_count() or 1
+        self.workers = workers
+        self.executor = self.make_executor()
+        self.max_inflight = max_inflight if max_inflight is not None else 2 * workers
+        # Keyed by block, queue holds blocks as well.
+        self.inflight: Dict[Tuple[int, int], Tuple[concurrent.futures.Future, float]] = {}
+        self.queue = []
+        r = radius
+        self.ring = np.array([(dx, dy) for dx in range(-r, r + 1) for dy in range(-r, r + 1)], dtype=np.int64)
+        # Previous actor positions sorted by id, for velocities.
+        self.last_ids = np.empty(0, dtype=np.int64)
+        self.last_positions = np.empty((0, 2), dtype=np.int64)
+        self.complete = set()
+        self.ticks = 0
+        self.generated = 0
+        self.blocks = 0
+        self.failed = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.latency_last = 0.0
+
+    def make_executor(self):
+        # Forking from the step thread would copy the state of the HTTP and render threads mid-flight.
+        return concurrent.futures.ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def restart(self):
+        """Replaces a pool broken by a dead worker, its blocks in flight fail and are collected as failed."""
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.executor = self.make_executor()
+
+    def priorities(self, velocity):
+        """Priority of every ring offset for a chunk whose actors move at velocity, lower goes first."""
+        distance = np.hypot(self.ring[:, 0], self.ring[:, 1])
+        speed = math.hypot(*velocity)
+        if speed == 0:
+            return distance
+        heading = (self.ring @ np.asarray(velocity, dtype=np.float64)) / (np.maximum(distance, 1e-9) * speed)
+        return np.where(distance == 0, 0.0, distance - DIRECTION_WEIGHT * heading)
+
+    def tick(self, ids: np.ndarray, positions: np.ndarray):
+        self.collect()
+        self.ticks += 1
+
+        # Velocity of each actor since the last tick, actors not seen before count as standing still.
+        velocities = np.zeros_like(positions)
+        if len(self.last_ids):
+            index = np.minimum(np.searchsorted(self.last_ids, ids), len(self.last_ids) - 1)
+            seen = self.last_ids[index] == ids
+            velocities[seen] = positions[seen] - self.last_positions[index[seen]]
+        order = np.argsort(ids)
+        self.last_ids, self.last_positions = ids[order], positions[order]
+
+        # Work is per distinct actor chunk, with the mean velocity of the actors in it.
+        chunks = np.floor_divide(positions, (self.simulation_map.chunk_x, self.simulation_map.chunk_y))
+        centres, inverse = np.unique(chunks, axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        counts = np.bincount(inverse, minlength=len(centres))
+        mean_velocity = np.stack([np.bincount(inverse, velocities[:, axis], minlength=len(centres))
+                                  for axis in (0, 1)], axis=1) / np.maximum(counts, 1)[:, None]
+
+        # Rings confirmed fully generated are skipped, and looked at again every RECHECK_TICKS in case of eviction.
+        if self.ticks % RECHECK_TICKS == 0:
+            self.complete = set()
+        complete = set()
+        wanted: Dict[Tuple[int, int], float] = {}
+        with self.simulation_map.lock:
+            for centre, velocity in zip(map(tuple, centres.tolist()), mean_velocity.tolist()):
+                if centre in self.complete:
+                    complete.add(centre)
+                    continue
+                ring_missing = False
+                for (dx, dy), priority in zip(self.ring.tolist(), self.priorities(velocity).tolist()):
+                    chunk_index = (centre[0] + dx, centre[1] + dy)
+                    if chunk_index in wanted:
+                        wanted[chunk_index] = min(wanted[chunk_index], priority)
+                        ring_missing = True
+                    elif not self.simulation_map.has_chunk(chunk_index):
+                        wanted[chunk_index] = priority
+                        ring_missing = True
+                if not ring_missing:
+                    complete.add(centre)
+        self.complete = complete
+
+        missing: Dict[Tuple[int, int], list] = {}
+        for chunk_index in sorted(wanted, key=wanted.get):
+            block = self.block_of(chunk_index)
+            if block not in self.inflight:
+                missing.setdefault(block, []).append(chunk_index)
+        # A block goes out at the priority of its most urgent chunk.
+        self.queue = list(missing.items())
+        while self.queue and len(self.inflight) < self.max_inflight:
+            block, chunk_indices = self.queue.pop(0)
+            # Only the bounding box of the missing chunks is generated, not necessarily the whole block.
+            xs, ys = zip(*chunk_indices)
+            try:
+                future = self.executor.submit(generate_chunks,
+                                              (self.simulation_map.chunk_x, self.simulation_map.chunk_y),
+                                              min(xs), min(ys), max(xs) - min(xs) + 1, max(ys) - min(ys) + 1,
+                                              self.simulation_map.seed)
+            except BrokenProcessPool as e:
+                print('got exception', e, 'pregenerating block', block)
+                self.failed += 1
+                self.restart()
+                break
+            self.inflight[block] = (future, time.monotonic())
+
+    def block_of(self, chunk_index):
+        return chunk_index[0] // self.block_size, chunk_index[1] // self.block_size
+
+    def collect(self):
+        now = time.monotonic()
+        for block, (future, submitted) in list(self.inflight.items()):
+            if not future.done():
+                continue
+            del self.inflight[block]
+            try:
+                chunks = future.result()
+            except Exception as e:
+                print('got exception', e, 'pregenerating block', block)
+                self.failed += 1
+                continue
+            for chunk_index, height_map, type_map in chunks:
+                self.simulation_map.insert_chunk(chunk_index, SimulationMap.from_arrays(height_map, type_map))
+            latency = now - submitted
+            CHUNK_GENERATE_SECONDS.observe(latency, source='pregeneration')
+            self.generated += len(chunks)
+            self.blocks += 1
+            self.latency_total += latency
+            self.latency_last = latency
+            self.latency_max = max(self.latency_max, latency)
+
+    def stats(self):
+        return {'queue_depth': len(self.queue), 'inflight': len(self.inflight), 'generated': self.generated,
+                'blocks': self.blocks, 'failed': self.failed,
+                'latency_last': self.latency_last, 'latency_max': self.latency_max,
+                'latency_mean': self.latency_total / self.blocks if self.blocks else 0.0}
+
+    def shutdown(self):
+        self.executor.shutdown(cancel_futures=True)
@@ -0,0 +1,41 @@
+import collections
+import sys
+import threading
+import time
+from typing import Counter, Optional
+
+MAX_PROFILE_SECONDS = 60
+
+
+def find_thread(name) -> Optional[threading.Thread]:
+    for thread in threading.enumerate():
+        if thread.name == name:
+            return thread
+    return None
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return '{}:{}:{}'.format(code.co_filename.rsplit('/', 1)[-1], code.co_name, frame.f_lineno)
+
+
+def sample_thread(thread_ident, seconds, interval=0.005) -> Counter[str]:
+    """Samples the stack of one thread from this one, nothing runs in the profiled thread itself."""
+    stacks = collections.Counter()
+    deadline = time.monotonic() + min(seconds, MAX_PROFILE_SECONDS)
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_ident)
+        if frame is None:
+            break
+        labels = []
+        while frame is not None:
+            labels.append(frame_label(frame))
+            frame = frame.f_back
+        stacks[';'.join(reversed(labels))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+def folded(stacks: Counter[str]):
+    """Collapsed stack format, one "frame;frame;frame count" line per stack, as read by flamegraph tools."""
+    return ''.join('{} {}\n'.format(stack, count) for stack, count in stacks.most_common())
@@ -1,4 +1,3 @@
-act = None
 direction: type
 tiletype_TYPE: type
 
@@ -10,7 +9,7 @@ def status(ctx):
 
 
 def step(ctx):
-    global act
+    act = ctx.state.act
     if act is not None:
         if type(act) is dict:
             act, extra = act['act'], act['args']
@@ -29,4 +28,4 @@ def step(ctx):
                 ctx.persistent_context.send_message(ctx.actor_id, extra)
             else:
                 print("UNKNOWN ACTION:", act)
-        act = None
+        ctx.state.act = None
@@ -1,11 +1,20 @@
 import enum
+import functools
 import inspect
-from typing import Dict
+import threading
+import time
+from typing import Dict, Optional
 
 import numpy as np
 
+from actions import DEFAULT_ACTIONS_PER_TICK, DEFAULT_MAX_PENDING, ActionQueues
+from actor_table import STATE_ATTRIBUTES, ActorTable
 from autoexpanding_map import AutoExpandingMap
 from map import TileType
+from metrics import SCRIPT_ERRORS, SCRIPT_SECONDS
+from messages import DEFAULT_MAX_PER_ACTOR, DEFAULT_RETENTION, MessageLog
+from spatial_index import SpatialHash
+from streaming import UpdateHub
 from . import player_function
 
 
@@ -16,20 +25,72 @@ class Direction(enum.Enum):
     W = enum.auto()
 
 
+AOI_RADIUS = 32
+# Deltas reaching further back than this are answered with a full snapshot of the area instead.
+DELTA_HISTORY = 4 * 15
+
+DIRECTION_OFFSETS = {Direction.N: (0, -1), Direction.S: (0, 1), Direction.W: (-1, 0), Direction.E: (1, 0)}
+
+
+def random_spawn_position():
+    return np.random.randint(-5, 5), np.random.randint(-5, 5)
+
+
 class RVMPersistentContext:
-    def __init__(self):
-        self.actors = {}
+    def __init__(self, seed=None, message_retention=DEFAULT_RETENTION, max_messages_per_actor=DEFAULT_MAX_PER_ACTOR,
+                 max_pending_actions=DEFAULT_MAX_PENDING, actions_per_tick=DEFAULT_ACTIONS_PER_TICK, **map_options):
+        self.chunk_shape = (32, 32)
+        self.spatial_index = SpatialHash(self.chunk_shape)
+        self.messages = MessageLog(message_retention, max_messages_per_actor)
+        self.actors = ActorTable(spatial_index=self.spatial_index, message_log=self.messages)
         self.actor_scripts: Dict[int, RVMScript] = {}
+        self.action_queues = ActionQueues(max_pending_actions, actions_per_tick)
         self.actor_id_counter = 0
-        self.chunk_shape = (32, 32)
-        self.simulation_map = AutoExpandingMap(self.chunk_shape)
+        self.simulation_map = AutoExpandingMap(self.chunk_shape, seed, **map_options)
         self.frame_count = 0
+        self.pregenerator = None
+        self.checkpointer = None
+        self.updates = UpdateHub()
+        # Read-only copies of actors owned by another shard near this one's borders, see set_ghosts.
+        self.ghost_index = SpatialHash(self.chunk_shape)
+        self.ghosts: Dict[int, dict] = {}
+        self.ghost_messages = MessageLog(message_retention, max_messages_per_actor)
+        # Held by step and by anything reading or changing actors from other threads.
+        self.lock = threading.RLock()
 
     def introspect_actor(self, attribute, viewing_actor, observed_actor):
         if observed_actor in self.actors and attribute in self.actors[observed_actor]:
             return self.actors[observed_actor][attribute]
+        ghost = self.ghosts.get(observed_actor)
+        if ghost is not None:
+            return self.ghost_messages.of(observed_actor) if attribute == 'messages' else ghost.get(attribute)
         return None
 
+    def set_ghosts(self, rows, messages):
+        """Replaces the ghost actors, rows are (actor_id, x, y, enabled, name, creation_time) and messages
+        (actor_id, timestamp, msg) posted on other shards since the last call.
+
+        Ghosts are seen by actors_at, actors_near, actors_in_chunk, look_actor, introspect_actor and
+        messages_since, but are never stepped and never reported in statuses.
+        """
+        with self.lock:
+            self.ghost_index = SpatialHash(self.chunk_shape)
+            self.ghosts = {}
+            for actor_id, x, y, enabled, name, creation_time in rows:
+                if actor_id in self.actors:
+                    continue
+                self.ghost_index.insert(actor_id, x, y)
+                self.ghosts[actor_id] = {'position': [x, y], 'enabled': enabled, 'name': name,
+                                         'creation_time': creation_time}
+            for actor_id, timestamp, msg in messages:
+                self.ghost_messages.post(actor_id, timestamp, msg)
+
+    def position_of(self, actor_id):
+        if actor_id in self.actors:
+            return self.actors.position(actor_id)
+        x, y = self.ghosts[actor_id]['position']
+        return x, y
+
     def create_player(self, player_name):
         return self.add_actor(PLAYER_SCRIPT_GEN(player_name))
 
@@ -37,55 +98,93 @@ class RVMPersistentContext:
         return self.simulation_map[x, y]
 
     def look_direction(self, direction: Direction, viewing_actor):
-        viewer_position = list(self.actors[viewing_actor]['position'])
-        if direction == Direction.N:
-            viewer_position[1] -= 1
-        elif direction == Direction.S:
-            viewer_position[1] += 1
-        elif direction == Direction.W:
-            viewer_position[0] -= 1
-        elif direction == Direction.E:
-            viewer_position[0] += 1
-        positioned_actor = list(filter(lambda k: self.actors[k]['position'] == viewer_position, self.actors.keys()))
+        dx, dy = DIRECTION_OFFSETS[direction]
+        vx, vy = self.actors.position(viewing_actor)
+        viewer_position = [vx + dx, vy + dy]
+        positioned_actor = self.actors_at(viewing_actor, *viewer_position)
         return viewer_position, positioned_actor[0] if len(positioned_actor) > 0 else None
 
+    def actors_at(self, viewing_actor, x, y):
+        return sorted(self.spatial_index.at(x, y) | self.ghost_index.at(x, y))
+
+    def actors_near(self, viewing_actor, radius):
+        vx, vy = self.actors.position(viewing_actor)
+        found = self.spatial_index.within_radius(vx, vy, radius) | self.ghost_index.within_radius(vx, vy, radius)
+        return sorted(found - {viewing_actor})
+
+    def actors_in_chunk(self, viewing_actor, chunk_x, chunk_y):
+        return sorted(self.spatial_index.in_cell(chunk_x, chunk_y) | self.ghost_index.in_cell(chunk_x, chunk_y))
+
     def move_direction(self, direction: Direction, actor_id):
-        viewer_position = self.actors[actor_id]['position']
-        if direction == Direction.N:
-            viewer_position[1] -= 1
-        elif direction == Direction.S:
-            viewer_position[1] += 1
-        elif direction == Direction.W:
-            viewer_position[0] -= 1
-        elif direction == Direction.E:
-            viewer_position[0] += 1
+        self.actors.move(actor_id, *DIRECTION_OFFSETS[direction])
 
     def step(self):
-        for a in self.actors:
-            if self.actors[a]['enabled']:
-                self.actor_scripts[a].execute(self, a)
-                self.actors[a]['messages'] = list(
-                    filter(lambda m: (self.frame_count - m['timestamp']) < (4 * 15), self.actors[a]['messages']))
+        with self.lock:
+            self.step_locked()
+
+    def step_locked(self):
+        self.actors.advance(self.frame_count)
+        drained = self.action_queues.drain_all()
+        for a in self.actors.enabled_ids():
+            if self.actors.is_enabled(a):
+                script = self.actor_scripts[a]
+                actions = drained.get(a, ())
+                try:
+                    if not actions:
+                        script.execute(self, a)
+                    for action in actions:
+                        script.state.act = action
+                        script.execute(self, a)
+                except ValueError:
+                    # execute already reported it, a failing script only loses its own actor's turn.
+                    script.state.act = None
+        self.messages.expire(self.frame_count)
+        self.ghost_messages.expire(self.frame_count)
+        self.actors.advance(self.frame_count + 1)
+        ids, positions = self.actors.enabled_positions()
+        self.simulation_map.pin_around(positions)
+        if self.pregenerator is not None:
+            self.pregenerator.tick(ids, positions)
         self.frame_count += 1
+        if self.checkpointer is not None:
+            self.checkpointer.tick(self.frame_count - 1)
+        self.updates.publish(self.frame_count)
 
     def send_message(self, sending_actor, message):
-        self.actors[sending_actor]['messages'].append({'timestamp': self.frame_count, 'msg': message})
-
-    def add_actor(self, script):
-        x = np.random.randint(-5, 5)
-        y = np.random.randint(-5, 5)
-        self.actors[self.actor_id_counter] = {'position': [x, y],
-                                              'enabled': True,
-                                              'creation_time': self.frame_count,
-                                              'name': script.name,
-                                              'messages': []}
-        self.actor_scripts[self.actor_id_counter] = script
-        self.actor_id_counter += 1
-        return self.actor_id_counter - 1
+        return self.messages.post(sending_actor, self.frame_count, message)
+
+    def messages_since(self, viewing_actor, frame):
+        messages = sorted(self.messages.since(frame) + self.ghost_messages.since(frame), key=lambda m: m.timestamp)
+        return [{'actor_id': m.actor_id, **m.to_dict()} for m in messages]
+
+    def add_actor(self, script, position=None, actor_id=None, creation_time=None):
+        if position is None:
+            x, y = random_spawn_position()
+        else:
+            x, y = position
+        with self.lock:
+            if actor_id is None:
+                actor_id = self.actor_id_counter
+            self.actors.add(actor_id, (x, y), self.frame_count if creation_time is None else creation_time,
+                            script.name)
+            self.actor_scripts[actor_id] = script
+            self.action_queues.open(actor_id)
+            self.actor_id_counter = max(self.actor_id_counter, actor_id + 1)
+            if self.checkpointer is not None:
+                self.checkpointer.spawned(actor_id, script, (x, y), self.actors[actor_id]['creation_time'])
+            return actor_id
+
+    def remove_actor(self, actor_id):
+        with self.lock:
+            self.actors.remove(actor_id)
+            self.action_queues.close(actor_id)
+            del self.actor_scripts[actor_id]
+            if self.checkpointer is not None:
+                self.checkpointer.removed(actor_id)
 
     def look_actor(self, viewing_actor, observed_actor):
-        vx, vy = self.actors[viewing_actor]['position']
-        ox, oy = self.actors[observed_actor]['position']
+        vx, vy = self.actors.position(viewing_actor)
+        ox, oy = self.position_of(observed_actor)
         xdelta = vx - ox
         ydelta = vy - oy
         dist = (xdelta ** 2 + ydelta ** 2) ** .5
@@ -95,52 +194,153 @@ class RVMPersistentContext:
             return (None, None), observed_actor
 
     def inspect_world(self, actor_id):
-        x, y = zip(*self.simulation_map.chunks.keys())
-
-        x1 = min(x)
-        x2 = max(x)
-        y1 = min(y)
-        y2 = max(y)
+        x1, x2, y1, y2 = self.simulation_map.bounds
 
         return x2 - x1, y2 - y1
 
     def status_of(self, user_id):
-        if user_id in self.actors and self.actors[user_id]['enabled']:
-            return self.actor_scripts[user_id].status(self, user_id)
-        else:
-            return {'error': 'unknown or disabled actor'}
+        with self.lock:
+            if self.actors.is_enabled(user_id):
+                return self.actor_scripts[user_id].status(self, user_id)
+            else:
+                return {'error': 'unknown or disabled actor'}
+
+    def world_status(self):
+        chunk_x = self.simulation_map.chunk_x
+        with self.lock:
+            ids = list(self.actors.keys())
+            positions = self.actors.positions[[self.actors.slot_of[k] for k in ids]]
+            chunkpos = np.stack((positions // chunk_x, positions % chunk_x), axis=2).tolist()
+            return {'actors': {k: a.to_dict() for k, a in self.actors.items()},
+                    'chunkpos': dict(zip(ids, chunkpos)),
+                    'world_frame': self.frame_count}
+
+    def delta_status(self, actor_id, since=None, radius=AOI_RADIUS):
+        with self.lock:
+            if not self.actors.is_enabled(actor_id):
+                return {'error': 'unknown or disabled actor'}
+            return self.delta_around(*self.actors.position(actor_id), since=since, radius=radius)
+
+    def delta_around(self, x, y, radius=AOI_RADIUS, since=None):
+        """Actors within radius of (x, y) that spawned, moved or changed since frame `since`.
+
+        Without `since`, or when it is older than DELTA_HISTORY, a full snapshot of the area is returned.
+        Changed actors are searched for in every spatial index cell the area touches, plus those that left
+        one of these cells, so clients also learn about actors leaving their area however far they went.
+        Clients should drop actors outside radius.
+        """
+        with self.lock:
+            full = since is None or since < self.frame_count - DELTA_HISTORY
+            if full:
+                since = 0
+                ids = sorted(self.spatial_index.within_radius(x, y, radius))
+            else:
+                cells = self.spatial_index.cells_around(x, y, radius)
+                nearby = self.spatial_index.in_cells(cells).union(self.actors.departed_since(since, cells))
+                ids = self.actors.changed_since(sorted(nearby), since)
+            visible = self.spatial_index.within_radius(x, y, radius)
+            chunk_x, chunk_y = self.chunk_shape
+            actors = {}
+            for k in ids:
+                actor = self.actors[k].to_dict(STATE_ATTRIBUTES)
+                actor['chunk'] = [actor['position'][0] // chunk_x, actor['position'][1] // chunk_y]
+                actors[k] = actor
+            return {'world_frame': self.frame_count,
+                    'since': since,
+                    'full': full,
+                    'center': [x, y],
+                    'radius': radius,
+                    'actors': actors,
+                    'messages': [{'actor_id': m.actor_id, **m.to_dict()} for m in self.messages.since(since)
+                                 if m.actor_id in visible],
+                    'despawned': [] if full else self.actors.removed_since(since)}
+
+    def chunks_near(self, actor_id, chunk_radius):
+        """Chunks within chunk_radius of the actor's chunk that are already generated."""
+        with self.lock:
+            if actor_id not in self.actors:
+                return []
+            cx, cy = self.simulation_map.chunk_of(*self.actors.position(actor_id))
+        return [(cx + dx, cy + dy)
+                for dx in range(-chunk_radius, chunk_radius + 1)
+                for dy in range(-chunk_radius, chunk_radius + 1)
+                if self.simulation_map.has_chunk((cx + dx, cy + dy))]
+
+    def enqueue_action(self, actor_id, action):
+        """Queues an action for the actor's next step, safe to call from any thread without the lock."""
+        return self.action_queues.submit(actor_id, action)
+
+
+class RVMScriptState:
+    """Per-actor script state, scripts keep what they need between steps as attributes on ctx.state."""
+
+    def __init__(self, name):
+        self.name = name
+        self.act = None
 
 
 class RVMTemporaryContext:
     persistent_context: RVMPersistentContext
 
-    def __init__(self, persistent_context: RVMPersistentContext, actor_id):
+    def __init__(self, persistent_context: RVMPersistentContext, actor_id, state: RVMScriptState = None):
         self.persistent_context = persistent_context
         self.actor_id = actor_id
+        self.state = state
+
+
+class RVMProgram:
+    """A script source compiled and executed once, its step/status functions are shared by every actor running it."""
+
+    def __init__(self, source, **kwargs):
+        self.source = source
+        self.environment = {**kwargs, 'direction': Direction, 'tiletype_TYPE': TileType}
+        exec(compile(source, '<rvmscript>', 'exec'), self.environment)
+        self.step = self.environment.get('step')
+        self.status = self.environment.get('status')
+
+
+@functools.lru_cache(maxsize=None)
+def compile_program(source) -> RVMProgram:
+    return RVMProgram(source)
 
 
 class RVMScript:
     def __init__(self, source, name, **kwargs):
         self.source = source
-        self.environment = {**kwargs, 'name': name, 'direction': Direction, 'tiletype_TYPE': TileType}
+        # Programs with extra globals are private to this script, plain sources are compiled once and shared.
+        self.program = RVMProgram(source, **kwargs) if kwargs else compile_program(source)
+        self.state = RVMScriptState(name)
         self.name = name
-        exec(source, self.environment)
+        self.context: Optional[RVMTemporaryContext] = None
+
+    def bind(self, persistent_ctx: RVMPersistentContext, actor_id):
+        context = self.context
+        if context is None or context.persistent_context is not persistent_ctx or context.actor_id != actor_id:
+            context = self.context = RVMTemporaryContext(persistent_ctx, actor_id, self.state)
+        return context
 
     def status(self, persistent_ctx: RVMPersistentContext, actor_id):
-        rvmTemporaryCtx = RVMTemporaryContext(persistent_ctx, actor_id)
+        start = time.perf_counter()
         try:
-            return eval('status(ctx)', self.environment, {'ctx': rvmTemporaryCtx})
+            return self.program.status(self.bind(persistent_ctx, actor_id))
         except Exception as e:
+            SCRIPT_ERRORS.inc(phase='status')
             print('got exception', e, 'executing script', self)
             raise ValueError(e, self)
+        finally:
+            SCRIPT_SECONDS.observe(time.perf_counter() - start, phase='status')
 
     def execute(self, persistent_ctx: RVMPersistentContext, actor_id):
-        rvmTemporaryCtx = RVMTemporaryContext(persistent_ctx, actor_id)
+        start = time.perf_counter()
         try:
-            eval('step(ctx)', self.environment, {'ctx': rvmTemporaryCtx})
+            self.program.step(self.bind(persistent_ctx, actor_id))
         except Exception as e:
+            SCRIPT_ERRORS.inc(phase='step')
             print('got exception', e, 'executing script', self)
             raise ValueError(e, self)
+        finally:
+            SCRIPT_SECONDS.observe(time.perf_counter() - start, phase='step')
 
 
-PLAYER_SCRIPT_GEN = lambda name: RVMScript(inspect.getsource(player_function), name=name)
+PLAYER_SCRIPT_SOURCE = inspect.getsource(player_function)
+PLAYER_SCRIPT_GEN = lambda name: RVMScript(PLAYER_SCRIPT_SOURCE, name=name)
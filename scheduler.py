@@ -0,0 +1,66 @@
+import threading
+import time
+from typing import Callable
+
+from metrics import TICK_SECONDS
+
+
+class TickScheduler:
+    """Calls step at a fixed rate, sleeping until each deadline instead of spinning.
+
+    A step that raises is reported and counted in failures, the next tick runs as usual.
+    """
+
+    def __init__(self, step: Callable[[], None], tick_rate=4.0, max_catch_up=4):
+        self.step = step
+        self.interval = 1.0 / tick_rate
+        self.max_catch_up = max_catch_up
+        self.stop_event = threading.Event()
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.failures = 0
+        self.drift = 0.0
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+        self.total_duration = 0.0
+
+    def run(self):
+        deadline = time.monotonic() + self.interval
+        while not self.stop_event.is_set():
+            wait = deadline - time.monotonic()
+            if wait > 0 and self.stop_event.wait(wait):
+                break
+            self.drift = time.monotonic() - deadline
+            due = int(self.drift // self.interval) + 1
+            # Ticks beyond the catch-up budget are dropped so a slow step cannot spiral.
+            run = min(due, self.max_catch_up)
+            self.skipped += due - run
+            for _ in range(run):
+                self.tick()
+            deadline += due * self.interval
+
+    def tick(self):
+        start = time.perf_counter()
+        try:
+            self.step()
+        except Exception as e:
+            print('got exception', e, 'stepping the world')
+            self.failures += 1
+        duration = time.perf_counter() - start
+        TICK_SECONDS.observe(duration)
+        self.ticks += 1
+        self.last_duration = duration
+        self.max_duration = max(self.max_duration, duration)
+        self.total_duration += duration
+        if duration > self.interval:
+            self.overruns += 1
+
+    def stop(self):
+        self.stop_event.set()
+
+    def stats(self):
+        return {'ticks': self.ticks, 'overruns': self.overruns, 'skipped': self.skipped, 'failures': self.failures,
+                'drift': self.drift,
+                'last_duration': self.last_duration, 'max_duration': self.max_duration,
+                'mean_duration': self.total_duration / self.ticks if self.ticks else 0.0}
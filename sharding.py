@@ -0,0 +1,388 @@
+import multiprocessing
+import os
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+
+import actions
+from chunk_store import stored_seed
+from rvm import rvm
+from streaming import UpdateHub
+
+# Regions are square blocks of chunks, each owned by exactly one shard.
+REGION_CHUNKS = 8
+# Map tiles up to this zoom level lie inside a single region, so one shard can draw them.
+MAX_TILE_LEVEL = REGION_CHUNKS.bit_length() - 1
+# Actors this many tiles or closer to another shard's region are copied to it as ghosts every tick.
+GHOST_MARGIN = 16
+# Returned by a shard asked about an actor it does not (or no longer) own.
+NOT_HERE = '__not_here__'
+
+
+def region_owner(chunk_x, chunk_y, shard_count):
+    """Shard owning the region of a chunk, works element-wise on NumPy arrays too."""
+    region_x = chunk_x // REGION_CHUNKS
+    region_y = chunk_y // REGION_CHUNKS
+    return ((region_x * 73856093) ^ (region_y * 19349663)) % shard_count
+
+
+class ShardError(Exception):
+    pass
+
+
+class ShardWorker:
+    """Runs in a worker process and steps the actors of every region its shard owns."""
+
+    def __init__(self, shard_id, shard_count, seed, options):
+        self.shard_id = shard_id
+        self.shard_count = shard_count
+        self.vm = rvm.RVMPersistentContext(seed=seed, **options)
+
+    def do_spawn(self, record):
+        script = rvm.PLAYER_SCRIPT_GEN(record['name']) if record['source'] is None else \
+            rvm.RVMScript(record['source'], record['name'])
+        vars(script.state).update(record['state'])
+        self.vm.add_actor(script, record['position'], record['actor_id'], record['creation_time'])
+        for action in record['actions']:
+            self.vm.enqueue_action(record['actor_id'], action)
+
+    def export(self, actor_id):
+        """Removes an actor that walked out of this shard's regions and returns what its new owner needs.
+
+        Its chat messages stay behind as ghost messages, so scripts here still see them until they expire.
+        """
+        vm = self.vm
+        script = vm.actor_scripts[actor_id]
+        record = {'actor_id': actor_id, 'name': script.name, 'position': vm.actors.position(actor_id),
+                  'source': None if script.source == rvm.PLAYER_SCRIPT_SOURCE else script.source,
+                  'state': vars(script.state), 'creation_time': vm.actors[actor_id]['creation_time'],
+                  'actions': list(vm.action_queues.queues[actor_id])}
+        messages = list(vm.messages.by_actor.get(actor_id, ()))
+        vm.remove_actor(actor_id)
+        for message in messages:
+            vm.ghost_messages.post(message.actor_id, message.timestamp, message.msg)
+        return record
+
+    def border_ghosts(self, ids, positions) -> Dict[int, list]:
+        """Rows of the actors within GHOST_MARGIN tiles of a region another shard owns, by that shard."""
+        vm = self.vm
+        m = GHOST_MARGIN
+        # The margin is far smaller than a region, so the corners of the box around an actor touch every
+        # region the box does.
+        owners = np.stack([region_owner(*np.floor_divide(positions + offset, vm.chunk_shape).T, self.shard_count)
+                           for offset in ((-m, -m), (-m, m), (m, -m), (m, m))])
+        ghosts: Dict[int, list] = {}
+        for i in np.flatnonzero((owners != self.shard_id).any(axis=0)).tolist():
+            actor_id = int(ids[i])
+            actor = vm.actors[actor_id]
+            x, y = positions[i].tolist()
+            row = (actor_id, x, y, True, actor['name'], actor['creation_time'])
+            for shard_id in set(owners[:, i].tolist()) - {self.shard_id}:
+                ghosts.setdefault(shard_id, []).append(row)
+        return ghosts
+
+    def do_step(self):
+        """Steps the shard and returns the actors it hands over, its border ghosts and this tick's messages."""
+        vm = self.vm
+        vm.step()
+        with vm.lock:
+            ids, positions = vm.actors.enabled_positions()
+            chunks = np.floor_divide(positions, vm.chunk_shape)
+            owners = region_owner(chunks[:, 0], chunks[:, 1], self.shard_count)
+            # Taken before the handoffs, which move the leaving actors' messages out of vm.messages.
+            messages = [(m.actor_id, m.timestamp, m.msg) for m in vm.messages.since(vm.frame_count - 1)]
+            staying = owners == self.shard_id
+            leaving = [(int(owners[i]), self.export(int(ids[i]))) for i in np.flatnonzero(~staying)]
+            return {'leaving': leaving, 'ghosts': self.border_ghosts(ids[staying], positions[staying]),
+                    'messages': messages}
+
+    def do_ghosts(self, rows, messages):
+        self.vm.set_ghosts(rows, messages)
+
+    def do_enqueue_action(self, actor_id, action):
+        if actor_id not in self.vm.actors:
+            return NOT_HERE
+        return self.vm.enqueue_action(actor_id, action)
+
+    def do_status_of(self, actor_id):
+        if actor_id not in self.vm.actors:
+            return NOT_HERE
+        return self.vm.status_of(actor_id)
+
+    def do_position(self, actor_id):
+        with self.vm.lock:
+            if actor_id not in self.vm.actors:
+                return NOT_HERE
+            return self.vm.actors.position(actor_id)
+
+    def do_chunks_near(self, actor_id, chunk_radius):
+        if actor_id not in self.vm.actors:
+            return NOT_HERE
+        return self.vm.chunks_near(actor_id, chunk_radius)
+
+    def do_delta_around(self, x, y, radius, since):
+        return self.vm.delta_around(x, y, radius, since)
+
+    def do_world_status(self):
+        return self.vm.world_status()
+
+    def do_encoded_chunk(self, chunk_x, chunk_y, ext):
+        return self.vm.simulation_map.encoded_chunk(chunk_x, chunk_y, ext)
+
+    def do_encoded_tile(self, z, tile_x, tile_y, ext):
+        return self.vm.simulation_map.encoded_tile(z, tile_x, tile_y, ext)
+
+
+def shard_main(connection, shard_id, shard_count, seed, options):
+    worker = ShardWorker(shard_id, shard_count, seed, options)
+    while True:
+        command, args = connection.recv()
+        if command == 'stop':
+            break
+        try:
+            result = getattr(worker, 'do_' + command)(*args)
+        except Exception as e:
+            result = ShardError('shard {} failed on {}: {!r}'.format(shard_id, command, e))
+        connection.send(result)
+    worker.vm.simulation_map.flush()
+    connection.close()
+
+
+class ShardHandle:
+    """Pipe to one shard process. A shard whose process died is marked dead and fails every later call."""
+
+    def __init__(self, context, shard_id, shard_count, seed, options):
+        self.shard_id = shard_id
+        self.dead = False
+        self.connection, child = context.Pipe()
+        self.process = context.Process(target=shard_main, args=(child, shard_id, shard_count, seed, options),
+                                       name='shard-{}'.format(shard_id), daemon=True)
+        self.process.start()
+        child.close()
+        self.lock = threading.Lock()
+
+    def begin(self, command, *args):
+        self.lock.acquire()
+        try:
+            if self.dead:
+                raise ShardError('shard {} is dead'.format(self.shard_id))
+            self.connection.send((command, args))
+        except (EOFError, OSError) as e:
+            self.dead = True
+            self.lock.release()
+            raise ShardError('shard {} died: {!r}'.format(self.shard_id, e)) from e
+        except BaseException:
+            self.lock.release()
+            raise
+
+    def finish(self):
+        try:
+            result = self.connection.recv()
+        except (EOFError, OSError) as e:
+            self.dead = True
+            raise ShardError('shard {} died: {!r}'.format(self.shard_id, e)) from e
+        finally:
+            self.lock.release()
+        if isinstance(result, ShardError):
+            raise result
+        return result
+
+    def call(self, command, *args):
+        self.begin(command, *args)
+        return self.finish()
+
+    def stop(self):
+        with self.lock:
+            self.connection.send(('stop', ()))
+        self.process.join()
+
+
+class ShardedMapRouter:
+    """Stands in for AutoExpandingMap in the HTTP front end, chunk images come from the shard owning the chunk."""
+
+    def __init__(self, world: 'ShardedWorld'):
+        self.world = world
+        self.chunk_x, self.chunk_y = world.chunk_shape
+        self.max_tile_level = MAX_TILE_LEVEL
+
+    def chunk_of(self, x, y):
+        return x // self.chunk_x, y // self.chunk_y
+
+    def cached_image(self, chunk_x, chunk_y, ext=".jpg"):
+        return None
+
+    def encoded_chunk(self, chunk_x, chunk_y, ext=".jpg"):
+        return self.world.shards[region_owner(chunk_x, chunk_y, len(self.world.shards))].call(
+            'encoded_chunk', chunk_x, chunk_y, ext)
+
+    def cached_tile(self, z, tile_x, tile_y, ext=".jpg"):
+        return None
+
+    def encoded_tile(self, z, tile_x, tile_y, ext=".jpg"):
+        return self.world.shards[region_owner(tile_x << z, tile_y << z, len(self.world.shards))].call(
+            'encoded_tile', z, tile_x, tile_y, ext)
+
+
+class ShardedWorld:
+    """RVMPersistentContext look-alike that spreads the world's regions over worker processes.
+
+    Every tick all shards step in parallel, then actors that crossed into another shard's region are
+    handed over. Requests about an actor go to the shard owning it, area queries are merged from all shards.
+    Actors within GHOST_MARGIN tiles of another shard's region are copied there as read-only ghosts and chat
+    is copied to every shard, so scripts see across borders one tick late. actors_near with a radius
+    above GHOST_MARGIN only sees that far into another shard's regions.
+    Chunk pregeneration and checkpointing are not available in this mode.
+    """
+
+    def __init__(self, shard_count, seed=None, store_directory: Optional[str] = None, **options):
+        if seed is None and store_directory is not None:
+            seed = stored_seed(os.path.join(store_directory, 'shard-0'))
+        self.seed = seed if seed is not None else int(np.random.SeedSequence().entropy)
+        self.chunk_shape = (32, 32)
+        context = multiprocessing.get_context('spawn')
+        self.shards: List[ShardHandle] = []
+        for shard_id in range(shard_count):
+            shard_options = dict(options)
+            if store_directory is not None:
+                shard_options['store_directory'] = os.path.join(store_directory, 'shard-{}'.format(shard_id))
+            self.shards.append(ShardHandle(context, shard_id, shard_count, self.seed, shard_options))
+        self.owner: Dict[int, int] = {}
+        self.actor_id_counter = 0
+        self.frame_count = 0
+        # Held by step for the whole tick including handoffs, and by anything changing ownership.
+        self.lock = threading.RLock()
+        self.updates = UpdateHub()
+        self.simulation_map = ShardedMapRouter(self)
+
+    def shard_of_position(self, x, y):
+        return region_owner(x // self.chunk_shape[0], y // self.chunk_shape[1], len(self.shards))
+
+    def create_player(self, player_name):
+        with self.lock:
+            actor_id = self.actor_id_counter
+            self.actor_id_counter += 1
+            position = rvm.random_spawn_position()
+            shard_id = self.shard_of_position(*position)
+            self.shards[shard_id].call('spawn', {'actor_id': actor_id, 'name': player_name, 'source': None,
+                                                 'position': position, 'state': {}, 'actions': [],
+                                                 'creation_time': self.frame_count})
+            self.owner[actor_id] = shard_id
+            return actor_id
+
+    def call_actor(self, actor_id, command, *args, default=None):
+        shard_id = self.owner.get(actor_id)
+        if shard_id is not None:
+            result = self.shards[shard_id].call(command, actor_id, *args)
+            if result != NOT_HERE:
+                return result
+        # The actor is being handed over, the lock is released once its new owner has it.
+        with self.lock:
+            shard_id = self.owner.get(actor_id)
+        if shard_id is None:
+            return default
+        result = self.shards[shard_id].call(command, actor_id, *args)
+        return default if result == NOT_HERE else result
+
+    def broadcast(self, calls):
+        """Runs (shard, command, args) calls in parallel, a failed call gives its ShardError instead of a result.
+
+        Every begun shard is finished even when another one failed or died, so no shard is left locked with
+        an unread reply in its pipe.
+        """
+        begun = []
+        try:
+            for shard, command, args in calls:
+                try:
+                    shard.begin(command, *args)
+                    begun.append((shard, None))
+                except ShardError as e:
+                    begun.append((None, e))
+        finally:
+            results = []
+            for shard, error in begun:
+                if shard is None:
+                    results.append(error)
+                    continue
+                try:
+                    results.append(shard.finish())
+                except ShardError as e:
+                    # A dead process shows up here too, finish marks the shard dead.
+                    results.append(e)
+        return results
+
+    def step(self):
+        with self.lock:
+            leaving = []
+            ghosts: List[list] = [[] for _ in self.shards]
+            messages: List[list] = [[] for _ in self.shards]
+            results = self.broadcast([(shard, 'step', ()) for shard in self.shards])
+            for source, result in enumerate(results):
+                if isinstance(result, ShardError):
+                    print('got exception', result, 'stepping shard')
+                    continue
+                leaving.extend(result['leaving'])
+                for shard_id, rows in result['ghosts'].items():
+                    ghosts[shard_id].extend(rows)
+                for shard_id in range(len(self.shards)):
+                    if shard_id != source:
+                        messages[shard_id].extend(result['messages'])
+            for shard_id, record in leaving:
+                try:
+                    self.shards[shard_id].call('spawn', record)
+                except ShardError as e:
+                    print('got exception', e, 'handing over actor', record['actor_id'])
+                    self.owner.pop(record['actor_id'], None)
+                    continue
+                self.owner[record['actor_id']] = shard_id
+            # Every shard gets a call, an empty one clears the ghosts of the last tick.
+            calls = [(shard, 'ghosts', (ghosts[i], messages[i])) for i, shard in enumerate(self.shards)]
+            for result in self.broadcast(calls):
+                if isinstance(result, ShardError):
+                    print('got exception', result, 'sending ghosts')
+            self.frame_count += 1
+        self.updates.publish(self.frame_count)
+
+    def status_of(self, user_id):
+        return self.call_actor(user_id, 'status_of', default={'error': 'unknown or disabled actor'})
+
+    def enqueue_action(self, actor_id, action):
+        return self.call_actor(actor_id, 'enqueue_action', action, default=actions.UNKNOWN_ACTOR)
+
+    def chunks_near(self, actor_id, chunk_radius):
+        return self.call_actor(actor_id, 'chunks_near', chunk_radius, default=[])
+
+    def delta_status(self, actor_id, since=None, radius=rvm.AOI_RADIUS):
+        position = self.call_actor(actor_id, 'position')
+        if position is None:
+            return {'error': 'unknown or disabled actor'}
+        return self.delta_around(*position, radius=radius, since=since)
+
+    def delta_around(self, x, y, radius=rvm.AOI_RADIUS, since=None):
+        parts = [shard.call('delta_around', x, y, radius, since) for shard in self.shards]
+        merged = {'world_frame': max(p['world_frame'] for p in parts),
+                  'since': min(p['since'] for p in parts),
+                  'full': any(p['full'] for p in parts),
+                  'center': [x, y],
+                  'radius': radius,
+                  'actors': {},
+                  'messages': [],
+                  'despawned': set()}
+        for part in parts:
+            merged['actors'].update(part['actors'])
+            merged['messages'].extend(part['messages'])
+            merged['despawned'].update(part['despawned'])
+        merged['messages'].sort(key=lambda m: m['timestamp'])
+        # Handed over actors show up as despawned in the shard they left.
+        merged['despawned'] = sorted(a for a in merged['despawned'] if a not in self.owner)
+        return merged
+
+    def world_status(self):
+        parts = [shard.call('world_status') for shard in self.shards]
+        return {'actors': {k: v for p in parts for k, v in p['actors'].items()},
+                'chunkpos': {k: v for p in parts for k, v in p['chunkpos'].items()},
+                'world_frame': max(p['world_frame'] for p in parts)}
+
+    def stop(self):
+        for shard in self.shards:
+            shard.stop()
@@ -0,0 +1,72 @@
+from collections import defaultdict
+from typing import Dict, Hashable, List, Set, Tuple
+
+
+class SpatialHash:
+    """Actor ids bucketed by exact tile and by cell, with cells the size of a map chunk."""
+
+    def __init__(self, cell_shape: Tuple[int, int]):
+        self.cell_x, self.cell_y = cell_shape
+        self.positions: Dict[Hashable, Tuple[int, int]] = {}
+        self.tiles: Dict[Tuple[int, int], Set[Hashable]] = defaultdict(set)
+        self.cells: Dict[Tuple[int, int], Set[Hashable]] = defaultdict(set)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, actor_id):
+        return actor_id in self.positions
+
+    def cell_of(self, x, y):
+        return x // self.cell_x, y // self.cell_y
+
+    def insert(self, actor_id, x, y):
+        if actor_id in self.positions:
+            self.remove(actor_id)
+        position = (int(x), int(y))
+        self.positions[actor_id] = position
+        self.tiles[position].add(actor_id)
+        self.cells[self.cell_of(*position)].add(actor_id)
+
+    def remove(self, actor_id):
+        position = self.positions.pop(actor_id)
+        self.discard(self.tiles, position, actor_id)
+        self.discard(self.cells, self.cell_of(*position), actor_id)
+
+    @staticmethod
+    def discard(buckets, key, actor_id):
+        bucket = buckets[key]
+        bucket.discard(actor_id)
+        if not bucket:
+            del buckets[key]
+
+    def move(self, actor_id, x, y):
+        self.insert(actor_id, x, y)
+
+    def at(self, x, y) -> Set[Hashable]:
+        return set(self.tiles.get((x, y), ()))
+
+    def in_cell(self, cell_x, cell_y) -> Set[Hashable]:
+        return set(self.cells.get((cell_x, cell_y), ()))
+
+    def cells_around(self, x, y, radius) -> List[Tuple[int, int]]:
+        """Cells overlapping the square that bounds the circle of radius around (x, y)."""
+        x1, y1 = self.cell_of(x - radius, y - radius)
+        x2, y2 = self.cell_of(x + radius, y + radius)
+        return [(cx, cy) for cx in range(x1, x2 + 1) for cy in range(y1, y2 + 1)]
+
+    def in_cells(self, cells) -> Set[Hashable]:
+        found = set()
+        for cell in cells:
+            found.update(self.cells.get(cell, ()))
+        return found
+
+    def within_radius(self, x, y, radius) -> Set[Hashable]:
+        found = set()
+        r2 = radius * radius
+        for cell in self.cells_around(x, y, radius):
+            for actor_id in self.cells.get(cell, ()):
+                ax, ay = self.positions[actor_id]
+                if (ax - x) ** 2 + (ay - y) ** 2 <= r2:
+                    found.add(actor_id)
+        return found
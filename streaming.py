@@ -0,0 +1,35 @@
+import threading
+from typing import Optional
+
+
+class UpdateHub:
+    """Wakes stream subscribers after every tick.
+
+    Only the latest frame number is kept, never a queue of updates: a subscriber that falls
+    behind computes one delta covering every frame it missed, so slow consumers get coalesced
+    state and cost no memory.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.frame = 0
+        self.subscribers = 0
+
+    def publish(self, frame):
+        with self.condition:
+            self.frame = frame
+            self.condition.notify_all()
+
+    def wait_after(self, frame, timeout) -> Optional[int]:
+        with self.condition:
+            if self.condition.wait_for(lambda: self.frame > frame, timeout):
+                return self.frame
+            return None
+
+    def subscribe(self):
+        with self.condition:
+            self.subscribers += 1
+
+    def unsubscribe(self):
+        with self.condition:
+            self.subscribers -= 1
@@ -0,0 +1,160 @@
+import os
+
+import pytest
+
+import checkpoint
+from rvm import rvm
+
+SEED = 3
+WALKER_SCRIPT = '''
+def step(ctx):
+    vm = ctx.persistent_context
+    if not hasattr(ctx.state, 'trail'):
+        ctx.state.trail = []
+    ctx.state.trail.append(vm.frame_count)
+    vm.move_direction(direction(ctx.actor_id % 4 + 1), ctx.actor_id)
+    if vm.frame_count % 3 == 0:
+        vm.send_message(ctx.actor_id, 'frame {}'.format(vm.frame_count))
+'''
+
+
+def make_world(directory, interval=1000):
+    vm = rvm.RVMPersistentContext(seed=SEED)
+    for i in range(5):
+        vm.add_actor(rvm.RVMScript(WALKER_SCRIPT, 'walker{}'.format(i)), (i * 7, -i * 5))
+    vm.checkpointer = checkpoint.Checkpointer(vm, directory, interval)
+    return vm
+
+
+def step(vm, frames):
+    for _ in range(frames):
+        vm.step()
+
+
+def actors_of(vm, states=False):
+    actors = {}
+    for actor_id in sorted(vm.actors.keys()):
+        actor = vm.actors[actor_id]
+        actors[actor_id] = (list(vm.actors.position(actor_id)), actor['enabled'], actor['name'],
+                            actor['creation_time'], vm.actor_scripts[actor_id].source)
+        if states:
+            actors[actor_id] += ({k: v for k, v in vars(vm.actor_scripts[actor_id].state).items() if k != 'act'},)
+    return actors
+
+
+def messages_of(vm):
+    return [(m.timestamp, m.actor_id, m.msg) for m in vm.messages.log]
+
+
+def restored(directory):
+    vm = rvm.RVMPersistentContext(seed=SEED)
+    frame = checkpoint.restore(vm, directory)
+    return vm, frame
+
+
+def test_restore_without_checkpoint(tmp_path):
+    assert restored(str(tmp_path))[1] is None
+
+
+def test_restore_snapshot(tmp_path):
+    vm = make_world(str(tmp_path))
+    step(vm, 5)
+    vm.checkpointer.start_segment(wait=True)
+    vm.checkpointer.shutdown()
+
+    copy, frame = restored(str(tmp_path))
+    assert frame == vm.frame_count == 5
+    assert actors_of(copy, states=True) == actors_of(vm, states=True)
+    assert messages_of(copy) == messages_of(vm)
+    assert copy.actor_id_counter == vm.actor_id_counter
+    assert checkpoint.stored_seed(str(tmp_path)) == vm.simulation_map.seed
+
+
+def test_snapshot_does_not_share_script_state(tmp_path):
+    vm = make_world(str(tmp_path))
+    step(vm, 2)
+    state = checkpoint.capture(vm)
+    step(vm, 2)
+    assert all(len(extra['trail']) == 2 for extra in state['meta']['states'].values())
+
+
+def test_restore_replays_journal(tmp_path):
+    vm = make_world(str(tmp_path))
+    step(vm, 4)
+    spawned = vm.add_actor(rvm.RVMScript(WALKER_SCRIPT, 'late'), (40, 40))
+    vm.remove_actor(1)
+    vm.actors[2]['enabled'] = False
+    step(vm, 5)
+    vm.checkpointer.shutdown()
+
+    copy, frame = restored(str(tmp_path))
+    assert frame == vm.frame_count == 9
+    assert spawned in copy.actors and 1 not in copy.actors
+    assert actors_of(copy) == actors_of(vm)
+    assert messages_of(copy) == messages_of(vm)
+
+
+def test_restore_stops_at_cut_off_record(tmp_path):
+    vm = make_world(str(tmp_path))
+    step(vm, 6)
+    vm.checkpointer.shutdown()
+    journal = checkpoint.journals(str(tmp_path))[-1]
+    with open(journal, 'a') as f:
+        f.write('{"frame": 6, "events": [["remove", 0]], "chan')
+
+    copy, frame = restored(str(tmp_path))
+    assert frame == vm.frame_count == 6
+    assert actors_of(copy) == actors_of(vm)
+
+
+def test_restore_when_snapshot_never_landed(tmp_path, monkeypatch):
+    vm = make_world(str(tmp_path), interval=3)
+
+    def fail(directory, state):
+        raise OSError('disk full')
+    monkeypatch.setattr(checkpoint, 'write_snapshot', fail)
+    other_script = WALKER_SCRIPT + '\n# another source\n'
+    step(vm, 1)
+    vm.add_actor(rvm.RVMScript(other_script, 'other'), (-9, 9))
+    step(vm, 3)
+    # The segments started from here number their script table without the walkers.
+    for actor_id in range(5):
+        vm.remove_actor(actor_id)
+    step(vm, 4)
+    vm.add_actor(rvm.RVMScript(other_script, 'other again'), (9, -9))
+    step(vm, 2)
+    vm.checkpointer.shutdown()
+
+    # Only the first snapshot exists, the journals of every later segment start with their own header.
+    assert [checkpoint.frame_of(path) for path in checkpoint.snapshots(str(tmp_path))] == [0]
+    assert len(checkpoint.journals(str(tmp_path))) > 1
+    assert not any(path.endswith('.tmp') for path in os.listdir(str(tmp_path)))
+
+    copy, frame = restored(str(tmp_path))
+    assert frame == vm.frame_count == 10
+    assert actors_of(copy) == actors_of(vm)
+    assert messages_of(copy) == messages_of(vm)
+
+
+def test_snapshot_replaces_older_segments(tmp_path):
+    vm = make_world(str(tmp_path), interval=3)
+    step(vm, 7)
+    vm.checkpointer.shutdown()
+
+    last = checkpoint.frame_of(checkpoint.snapshots(str(tmp_path))[-1])
+    assert last > 0
+    assert all(checkpoint.frame_of(path) >= last
+               for path in checkpoint.snapshots(str(tmp_path)) + checkpoint.journals(str(tmp_path)))
+    copy, frame = restored(str(tmp_path))
+    assert frame == 7
+    assert actors_of(copy) == actors_of(vm)
+
+
+@pytest.mark.parametrize('frames', [0, 1])
+def test_restore_fresh_world(tmp_path, frames):
+    vm = make_world(str(tmp_path))
+    step(vm, frames)
+    vm.checkpointer.shutdown()
+    copy, frame = restored(str(tmp_path))
+    assert frame == frames
+    assert actors_of(copy) == actors_of(vm)
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from autoexpanding_map import AutoExpandingMap
+from chunk_store import RegionChunkStore, stored_seed
+from map import SimulationMap
+
+SHAPE = (32, 32)
+SEED = 7
+
+
+def test_save_and_reload(tmp_path):
+    store = RegionChunkStore(str(tmp_path), SHAPE, SEED)
+    chunks = {index: SimulationMap(SHAPE, *index, seed=SEED) for index in [(0, 0), (3, -2), (-17, 40)]}
+    for index, chunk in chunks.items():
+        store.save(index, chunk)
+    store.flush()
+
+    reopened = RegionChunkStore(str(tmp_path), SHAPE)
+    assert reopened.seed == SEED == stored_seed(str(tmp_path))
+    for index, chunk in chunks.items():
+        assert index in reopened
+        loaded = reopened.load(index)
+        assert np.array_equal(loaded.height_map, chunk.height_map)
+        assert np.array_equal(loaded.type_map, chunk.type_map)
+    assert (1, 0) not in reopened
+    assert reopened.load((1, 0)) is None
+    assert reopened.load((1000, 1000)) is None
+
+
+def test_new_store_records_a_seed(tmp_path):
+    store = RegionChunkStore(str(tmp_path), SHAPE)
+    assert store.seed is not None
+    assert RegionChunkStore(str(tmp_path), SHAPE).seed == store.seed
+
+
+def test_seed_mismatch(tmp_path):
+    RegionChunkStore(str(tmp_path), SHAPE, SEED)
+    with pytest.raises(ValueError):
+        RegionChunkStore(str(tmp_path), SHAPE, SEED + 1)
+
+
+def test_layout_mismatch(tmp_path):
+    RegionChunkStore(str(tmp_path), SHAPE, SEED)
+    with pytest.raises(ValueError):
+        RegionChunkStore(str(tmp_path), (16, 16), SEED)
+    with pytest.raises(ValueError):
+        RegionChunkStore(str(tmp_path), SHAPE, SEED, region_size=8)
+
+
+def test_open_regions_are_bounded(tmp_path):
+    store = RegionChunkStore(str(tmp_path), SHAPE, SEED, max_open=2)
+    indices = [(r * store.region_size, 0) for r in range(5)]
+    for index in indices:
+        store.save(index, SimulationMap(SHAPE, *index, seed=SEED))
+        assert len(store.regions) <= 2
+    for index in indices:
+        assert np.array_equal(store.load(index).type_map, SimulationMap(SHAPE, *index, seed=SEED).type_map)
+    assert len(store.regions) <= 2
+
+
+def test_map_reloads_chunks_from_store(tmp_path):
+    world = AutoExpandingMap(SHAPE, SEED, store_directory=str(tmp_path))
+    generated = world.get_chunk((2, 5))
+    world.flush()
+
+    reopened = AutoExpandingMap(SHAPE, store_directory=str(tmp_path))
+    assert reopened.seed == SEED
+    assert reopened.has_chunk((2, 5)) and not reopened.has_chunk((2, 6))
+    assert np.array_equal(reopened.get_chunk((2, 5)).type_map, generated.type_map)
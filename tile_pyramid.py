@@ -0,0 +1,111 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from metrics import CHUNK_ENCODE_SECONDS, CHUNK_RENDER_SECONDS
+from visualization import EncodedImage, TileSet
+
+# At this level a tile covers 16x16 chunks and every map tile is a single pixel.
+MAX_LEVEL = 4
+DEFAULT_MAX_TILES = 512
+
+
+class TilePyramid:
+    """Zoomed-out map images, level z covers 2^z x 2^z chunks in an image the size of one chunk's.
+
+    Levels above 0 are drawn straight from the type maps with a tile atlas shrunk to 16 / 2^z pixels,
+    chunks that were never generated are left black and evicted ones are generated again from the seed.
+    Level 0 is the chunk image itself.
+    """
+
+    def __init__(self, simulation_map, tileset: TileSet, max_level=MAX_LEVEL, max_tiles=DEFAULT_MAX_TILES):
+        self.simulation_map = simulation_map
+        self.max_level = max_level
+        self.max_tiles = max_tiles
+        self.atlases = {0: tileset.atlas}
+        for z in range(1, max_level + 1):
+            size = tileset.size >> z
+            self.atlases[z] = np.stack([cv2.resize(tile, (size, size), interpolation=cv2.INTER_AREA).reshape(
+                size, size, -1) for tile in tileset.atlas])
+        self.images: 'OrderedDict[Tuple[int, int, int, str], EncodedImage]' = OrderedDict()
+        # [version, renders in flight] of the tiles being rendered. The version is bumped whenever the tile
+        # goes stale, so a render that raced with a new chunk is not cached. Dropped once no render is left.
+        self.versions: Dict[Tuple[int, int, int], List[int]] = {}
+        self.lock = threading.Lock()
+
+    def chunks_of(self, z, tile_x, tile_y):
+        n = 1 << z
+        return [(tile_x * n + i, tile_y * n + j) for i in range(n) for j in range(n)]
+
+    def render_tile(self, z, tile_x, tile_y):
+        start = time.perf_counter()
+        n = 1 << z
+        atlas = self.atlases[z]
+        size = atlas.shape[1]
+        chunk_x, chunk_y = self.simulation_map.chunk_x, self.simulation_map.chunk_y
+        img = np.zeros((n * chunk_y * size, n * chunk_x * size, atlas.shape[-1]), dtype=atlas.dtype)
+        for cx, cy in self.chunks_of(z, tile_x, tile_y):
+            if not self.simulation_map.was_generated((cx, cy)):
+                continue
+            tiles = atlas[self.simulation_map.get_chunk((cx, cy)).type_map.T]
+            i, j = cx - tile_x * n, cy - tile_y * n
+            img[j * chunk_y * size:(j + 1) * chunk_y * size, i * chunk_x * size:(i + 1) * chunk_x * size] = \
+                tiles.transpose(0, 2, 1, 3, 4).reshape(chunk_y * size, chunk_x * size, atlas.shape[-1])
+        CHUNK_RENDER_SECONDS.observe(time.perf_counter() - start)
+        return img
+
+    def cached_tile(self, z, tile_x, tile_y, ext=".jpg") -> Optional[EncodedImage]:
+        if z == 0:
+            return self.simulation_map.cached_image(tile_x, tile_y, ext)
+        key = (z, tile_x, tile_y, ext)
+        with self.lock:
+            image = self.images.get(key)
+            if image is not None:
+                self.images.move_to_end(key)
+            return image
+
+    def encoded_tile(self, z, tile_x, tile_y, ext=".jpg") -> Optional[EncodedImage]:
+        if z == 0:
+            return self.simulation_map.encoded_chunk(tile_x, tile_y, ext)
+        image = self.cached_tile(z, tile_x, tile_y, ext)
+        if image is not None:
+            return image
+        tile = (z, tile_x, tile_y)
+        with self.lock:
+            entry = self.versions.setdefault(tile, [0, 0])
+            entry[1] += 1
+            version = entry[0]
+        image = None
+        try:
+            img = self.render_tile(z, tile_x, tile_y)
+            start = time.perf_counter()
+            succ, enc = cv2.imencode(ext, img)
+            CHUNK_ENCODE_SECONDS.observe(time.perf_counter() - start, format=ext)
+            if succ:
+                image = EncodedImage.of(enc.tobytes())
+        finally:
+            with self.lock:
+                if image is not None and entry[0] == version:
+                    self.images[(z, tile_x, tile_y, ext)] = image
+                    while len(self.images) > self.max_tiles:
+                        self.images.popitem(last=False)
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.versions[tile]
+        return image
+
+    def invalidate(self, chunk_index, formats):
+        """Drops the one tile per level that shows a newly generated chunk."""
+        cx, cy = chunk_index
+        with self.lock:
+            for z in range(1, self.max_level + 1):
+                tile = (z, cx >> z, cy >> z)
+                entry = self.versions.get(tile)
+                if entry is not None:
+                    entry[0] += 1
+                for ext in formats:
+                    self.images.pop((*tile, ext), None)
@@ -1,8 +1,30 @@
+import hashlib
+from typing import NamedTuple, Optional
+
 import cv2
+import numpy as np
 
 from map import TileType
 
 
+class EncodedImage(NamedTuple):
+    data: bytes
+    etag: str
+
+    @classmethod
+    def of(cls, data: bytes):
+        return cls(data, '"{}"'.format(hashlib.blake2b(data, digest_size=16).hexdigest()))
+
+    def matches(self, if_none_match: Optional[str]):
+        for tag in (if_none_match or '').split(','):
+            tag = tag.strip()
+            if tag.startswith('W/'):
+                tag = tag[2:]
+            if tag == '*' or tag == self.etag:
+                return True
+        return False
+
+
 class TileSet:
     def __init__(self, size):
         tileset = cv2.imread('tileset.png')
@@ -15,6 +37,10 @@ class TileSet:
         self.size = size
         self.tilemap = {TileType.GRASS.value: 0, TileType.SAND.value: 8, TileType.WATER.value: 7,
                         TileType.STONE.value: 27}
+        # Tiles stacked by tile type value, so a whole type map can be rendered with one gather.
+        self.atlas = np.zeros((max(self.tilemap) + 1, size, size, tileset.shape[2]), dtype=tileset.dtype)
+        for tile_type, tile_index in self.tilemap.items():
+            self.atlas[tile_type] = self.tiles[tile_index]
 
     def __getitem__(self, item):
         return self.tiles[self.tilemap[item]]